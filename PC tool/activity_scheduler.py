@@ -0,0 +1,41 @@
+# activity_scheduler.py - 閒置降頻排程
+# 功能: 1. 旋鈕一段時間沒有動作、前景程式也沒有切換時，主迴圈自動降為低頻心跳。
+#       2. 閒置時直接阻塞在序列埠讀取上，收到第一個位元組就立刻回到全速；
+#          前景切換則在下一次心跳時偵測到並回到全速。
+
+import time
+
+IDLE_AFTER = 30.0     # 多久沒有活動後進入閒置模式 (秒)
+IDLE_INTERVAL = 1.0   # 閒置模式下的心跳間隔 (秒)
+
+class ActivityScheduler:
+    def __init__(self, active_interval, idle_interval=IDLE_INTERVAL, idle_after=IDLE_AFTER):
+        self.active_interval = active_interval
+        self.idle_interval = idle_interval
+        self.idle_after = idle_after
+        self.last_activity = time.monotonic()
+        self._last_foreground = None
+
+    def touch(self):
+        """記錄一次活動，回到全速"""
+        self.last_activity = time.monotonic()
+
+    def foreground(self, key):
+        """回報目前的前景視窗/程式，與上次不同時視為活動"""
+        if key != self._last_foreground:
+            self._last_foreground = key
+            self.touch()
+
+    def is_idle(self):
+        return time.monotonic() - self.last_activity > self.idle_after
+
+    def interval(self):
+        return self.idle_interval if self.is_idle() else self.active_interval
+
+    def read_line(self, ser):
+        """以目前的間隔作為逾時讀取一行指令 (取代固定的 sleep 輪詢)"""
+        timeout = self.interval()
+        if ser.timeout != timeout: ser.timeout = timeout  # 設定逾時需呼叫系統 API，只在切換時才設
+        line = ser.readline()
+        if line: self.touch()
+        return line
@@ -0,0 +1,81 @@
+# command_dispatch.py - 表格式指令分派
+# 功能: 1. 韌體送來的每一行只解析一次成 Command (device_protocol.parse_frame)，
+#          再查「動作對照表」呼叫對應的處理函式。
+#       2. 對照表從使用者設定檔 actions.json 載入，可以針對個別通道改變手勢的動作，例如:
+#          {"default": {"MUTE": "mute"}, "channels": {"1": {"MUTE": "media_play_pause"}}}
+#       3. 對照表在啟動時就轉成 (通道, 手勢) -> 函式 的 dict，每次分派最多兩次查表，
+#          與設定了多少動作無關。
+#
+#   可用的動作:
+#     volume_up / volume_down / mute   - 調整目前目標的音量 / 靜音
+#     mic_mute                         - 切換麥克風靜音
+#     next_target / prev_target        - 切換 (並鎖定) 目標程式
+#     auto_target                      - 解除鎖定，回到自動偵測前景
+#     media_play_pause / media_next / media_prev / media_stop - 模擬鍵盤媒體鍵
+#     none                             - 不做任何事
+
+import json
+import os
+
+ACTIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "actions.json")
+
+# 沒有設定檔時的預設對照 (與舊版硬編碼的行為相同)
+DEFAULT_ACTIONS = {"UP": "volume_up", "DOWN": "volume_down", "MUTE": "mute", "MIC_MUTE": "mic_mute",
+                   "NEXT_APP": "next_target", "PREV_APP": "prev_target", "UNLOCK": "auto_target"}
+
+# 媒體鍵的 Windows 虛擬按鍵碼
+MEDIA_KEYS = {"media_play_pause": 0xB3, "media_next": 0xB0, "media_prev": 0xB1, "media_stop": 0xB2}
+
+KNOWN_ACTIONS = set(DEFAULT_ACTIONS.values()) | set(MEDIA_KEYS) | {"none"}
+KNOWN_GESTURES = set(DEFAULT_ACTIONS)  # 韌體會送出的所有手勢
+
+def load_action_map(path=ACTIONS_FILE):
+    """讀取設定檔，回傳 {(通道 或 None, 手勢): 動作名稱}，None 代表所有通道的預設值。
+    設定檔無法讀取或格式錯誤時一律拋出 ValueError (訊息可直接顯示給使用者)"""
+    action_map = {(None, gesture): action for gesture, action in DEFAULT_ACTIONS.items()}
+    if not os.path.exists(path): return action_map
+    try:
+        with open(path, encoding="utf-8") as f: config = json.load(f)
+        for gesture, action in config.get("default", {}).items():
+            action_map[(None, gesture)] = action
+        for channel, gestures in config.get("channels", {}).items():
+            if not channel.isdigit(): raise ValueError(f"通道必須是數字: {channel!r}")
+            for gesture, action in gestures.items():
+                action_map[(int(channel), gesture)] = action
+    except (OSError, ValueError, AttributeError) as e:
+        # json 語法錯誤 (JSONDecodeError 屬於 ValueError)、欄位型別不是物件等
+        raise ValueError(f"{os.path.basename(path)} 格式錯誤: {e}") from e
+    # 手勢拼錯 (例如 "UPP") 永遠不會被觸發，與未知的動作一樣直接報錯
+    unknown = sorted({gesture for _, gesture in action_map if gesture not in KNOWN_GESTURES})
+    if unknown: raise ValueError(f"{os.path.basename(path)}: 未知的手勢 {', '.join(unknown)} (可用: {', '.join(sorted(KNOWN_GESTURES))})")
+    unknown = sorted({str(action) for action in action_map.values() if not isinstance(action, str) or action not in KNOWN_ACTIONS})
+    if unknown: raise ValueError(f"{os.path.basename(path)}: 未知的動作 {', '.join(unknown)}")
+    return action_map
+
+def press_media_key(vk, count=1):
+    import win32api, win32con  # 只有用到媒體鍵時才載入
+    for _ in range(count):
+        win32api.keybd_event(vk, 0, 0, 0)
+        win32api.keybd_event(vk, 0, win32con.KEYEVENTF_KEYUP, 0)
+
+def _ignore(command): pass
+
+class Dispatcher:
+    def __init__(self, handlers, action_map=None):
+        """handlers: {動作名稱: 函式(command)}，由各控制程式提供；媒體鍵動作內建。
+        設定檔用到了此控制程式不支援的動作時，該手勢會被忽略。"""
+        if action_map is None: action_map = load_action_map()
+        self._table = {}
+        for key, action in action_map.items():
+            if action in MEDIA_KEYS:
+                vk = MEDIA_KEYS[action]
+                self._table[key] = lambda command, vk=vk: press_media_key(vk, command.count)
+            else:
+                self._table[key] = handlers.get(action, _ignore)
+
+    def dispatch(self, command):
+        """依 (通道, 手勢) 查表執行，找不到通道專屬設定時使用預設；回傳是否有對應的動作"""
+        handler = self._table.get((command.channel, command.name)) or self._table.get((None, command.name))
+        if handler is None: return False
+        handler(command)
+        return True
@@ -0,0 +1,96 @@
+# device_protocol.py - 韌體指令格式解析
+# 功能: 解析 RP2040 送來的帶通道編號指令 "<通道>:<指令>[:<次數>]"，
+#       例如 "0:UP:3"、"1:MUTE"。同時相容舊版韌體的無通道格式 ("UP")。
+#       連線握手: 主機開啟序列埠後立即送出 "HELLO:<協定版本>:<音量>:<靜音>:<麥克風靜音>"，
+#       韌體套用後回覆 "HELLO:<韌體版本>:<協定版本>:<功能,...>:<亮度%>:<模式>"。
+#       舊版韌體不認得 HELLO 也不會回覆，主機就繼續使用舊的 "V:<音量>" 格式。
+#       麥克風欄位為 "-" 表示此控制程式不管理麥克風 (裝置視為未靜音)。
+#       StateSync 負責決定何時送出 HELLO: 等目標的實際狀態讀到後才送，HELLO 帶的一定是真實狀態。
+
+import threading
+import time
+from collections import namedtuple
+
+# 解析後的指令: 通道編號、手勢名稱 (UP/DOWN/MUTE...)、合併的次數
+Command = namedtuple("Command", "channel name count")
+
+PROTOCOL_VERSION = 2
+HELLO_TIMEOUT = 0.5   # 目標狀態一直讀不到 (例如程式卡住) 時，最多等多久就先以空狀態握手 (秒)
+
+# 握手得到的裝置資訊；capabilities 為韌體支援的功能名稱:
+#   CH    - 指令帶通道編號       BATCH - 多格旋轉合併為一個指令
+#   TRACE - 支援 "TRACE:1"      STATE - 接受 "S:<音量>:<靜音>:<麥克風靜音>" 完整狀態
+DeviceInfo = namedtuple("DeviceInfo", "firmware protocol capabilities brightness mode")
+LEGACY_DEVICE = DeviceInfo("?", 1, frozenset(), None, None)
+
+def parse_frame(line):
+    """將一行指令解析為 Command(通道, 指令, 次數)，舊格式一律視為通道 0、次數 1"""
+    parts = line.split(":")
+    channel, count = 0, 1
+    if len(parts) > 1 and parts[0].isdigit():
+        channel = int(parts.pop(0))
+    command = parts[0]
+    if len(parts) > 1:
+        try: count = max(1, int(parts[1]))
+        except ValueError: pass
+    return Command(channel, command, count)
+
+def volume_step(time_diff, count, min_timediff, max_timediff, min_step, max_step):
+    """動態加速度: 以每格平均間隔計算步進，再乘上合併的格數"""
+    clamped_diff = max(min_timediff, min(time_diff / count, max_timediff))
+    speed_ratio = (max_timediff - clamped_diff) / (max_timediff - min_timediff)
+    return (min_step + (max_step - min_step) * speed_ratio) * count
+
+def _mic_field(mic_muted):
+    return "-" if mic_muted is None else str(int(bool(mic_muted)))
+
+def hello_frame(volume, muted, mic_muted=None):
+    """連線時送出的握手，附上目前目標的音量百分比與靜音狀態"""
+    return f"HELLO:{PROTOCOL_VERSION}:{volume}:{int(bool(muted))}:{_mic_field(mic_muted)}\n".encode("utf-8")
+
+def parse_hello(line):
+    """解析韌體的握手回覆，回傳 DeviceInfo；格式不符時回傳 None"""
+    parts = line.split(":")
+    if len(parts) != 6 or parts[0] != "HELLO": return None
+    try: return DeviceInfo(parts[1], int(parts[2]), frozenset(filter(None, parts[3].split(","))), int(parts[4]), parts[5])
+    except ValueError: return None
+
+def state_frame(device, volume, muted, mic_muted=None):
+    """LED 狀態指令: 裝置支援 STATE 時送完整狀態，否則送舊版 "V:<音量>" (靜音顯示為 0)"""
+    if "STATE" in device.capabilities:
+        return f"S:{volume}:{int(bool(muted))}:{_mic_field(mic_muted)}\n".encode("utf-8")
+    return f"V:{0 if muted else volume}\n".encode("utf-8")
+
+class StateSync:
+    """連線握手與 LED 同步: 第一次送出的狀態就是 HELLO (帶真實狀態)，之後改送 S/V 指令。
+    push() 可由主迴圈與音量寫入執行緒 (on_refresh) 同時呼叫。"""
+    def __init__(self, writer, hello_timeout=HELLO_TIMEOUT):
+        self.writer = writer
+        self.device = LEGACY_DEVICE     # 收到握手回覆前一律視為舊版韌體
+        self.hello_sent = False
+        self.hello_timeout = hello_timeout
+        self._opened = time.monotonic()
+        self._lock = threading.Lock()
+
+    def push(self, volume, muted, mic_muted=None):
+        """送出目前目標的狀態 (volume 為 0.0~1.0)；還沒讀到實際音量 (None) 時不送，回傳是否送出"""
+        if volume is None: return False
+        with self._lock:
+            kind, frame = ("V", state_frame(self.device, int(volume * 100), muted, mic_muted)) if self.hello_sent \
+                else ("HELLO", hello_frame(int(volume * 100), muted, mic_muted))
+            self.hello_sent = True
+        self.writer.send(kind, frame)
+        return True
+
+    def hello_if_idle(self, has_target, mic_muted=None):
+        """尚未握手時，若沒有目標 (LED 本來就該全暗) 或等待目標狀態逾時，就以空狀態握手"""
+        if self.hello_sent: return
+        if has_target and time.monotonic() - self._opened < self.hello_timeout: return
+        self.push(0.0, False, mic_muted)
+
+    def handle_line(self, line):
+        """處理韌體的握手回覆，回傳 DeviceInfo；不是握手回覆時回傳 None"""
+        if not line.startswith("HELLO:"): return None
+        info = parse_hello(line)
+        if info: self.device = info
+        return self.device
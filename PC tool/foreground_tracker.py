@@ -0,0 +1,49 @@
+# foreground_tracker.py - 前景視窗防抖追蹤
+# 功能: 1. 前景視窗必須停留超過 settle 秒才算「穩定」，快速 Alt-Tab 或通知、啟動器等
+#          短暫出現的視窗不會改變目標，也不會觸發 session 查詢與 LED 更新。
+#       2. 最近用過的 (視窗, PID) -> 綁定結果 存在小型 MRU 快取，在常用程式之間切換
+#          不需要重新查詢 psutil / pycaw。
+#       3. session 清單改變時呼叫 invalidate() 清除快取 (綁定的通常是清單中的索引)。
+
+import collections
+import time
+
+FOREGROUND_SETTLE = 0.25   # 前景視窗停留多久才切換目標 (秒)
+MRU_SIZE = 8               # 快取最近幾個視窗的綁定
+
+class ForegroundTracker:
+    def __init__(self, resolve, settle=FOREGROUND_SETTLE, mru_size=MRU_SIZE):
+        """resolve(hwnd, pid): 查出視窗對應的綁定 (例如 session 索引，找不到回傳 None)，
+        只在前景穩定且快取中沒有時才呼叫；拋出的例外會直接傳給呼叫者，下次再重試。"""
+        self.resolve = resolve
+        self.settle = settle
+        self.mru_size = mru_size
+        self.current = None        # 目前穩定的 (hwnd, pid)
+        self.binding = None        # current 的綁定
+        self._cache = collections.OrderedDict()
+        self._candidate, self._candidate_since = None, 0.0
+
+    def invalidate(self):
+        """清除快取，下一次 update() 重新查詢目前的前景 (不必再等待穩定)"""
+        self._cache.clear()
+
+    def update(self, hwnd, pid):
+        """回報這次看到的前景視窗，回傳穩定前景的綁定；新視窗還沒穩定時維持舊的綁定"""
+        key = (hwnd, pid)
+        if key != self.current:
+            now = time.monotonic()
+            if key != self._candidate: self._candidate, self._candidate_since = key, now
+            # 第一次 (剛連線) 不等待，之後的切換都要停留超過 settle 秒
+            if self.current is not None and now - self._candidate_since < self.settle: return self.binding
+            self.current = key
+        self._candidate = None
+        if key in self._cache: self._cache.move_to_end(key)
+        else:
+            try: self._cache[key] = self.resolve(hwnd, pid)
+            except Exception:
+                # 查詢失敗就回到「尚無穩定前景」，下次直接重新查詢，不會回傳過期的綁定
+                self.current = None
+                raise
+            if len(self._cache) > self.mru_size: self._cache.popitem(last=False)
+        self.binding = self._cache[key]
+        return self.binding
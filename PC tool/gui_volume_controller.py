@@ -1,25 +1,88 @@
 # gui_volume_controller.py - 最終完美版 (隱藏式手動控制)
 # 功能: 1. 預設為極簡介面並自動連接。
 #       2. 新增一個「設定」按鈕，點擊後才會顯示手動選擇COM Port的控制項。
+#       3. 支援多旋鈕韌體: 通道 0 沿用自動偵測/手動鎖定，其他通道各自控制自己的程式。
+#       4. 音量寫入交給背景寫入器 (VolumeWriter)，慢速程式不會卡住指令迴圈。
+#       5. 閒置一段時間後降為低頻心跳，轉動旋鈕或切換前景視窗時立即回到全速。
+#       6. 群組模式: 一次控制同一執行檔 (或同一程序樹) 的所有音訊 session。
+#       7. 可選的時間軸追蹤 (TRACE_FILE)，記錄各執行緒與韌體的工作區段。
+#       8. 快速啟動: serial/comtypes/pycaw 等後端模組延後到控制執行緒才載入，
+#          視窗先出現，後端在背景同時暖機；並記錄啟動各階段花費的時間。
+#       9. 送往裝置的資料由 SerialWriter 在背景寫出，同種類的舊訊息會被新的取代。
+#      10. 指令改由共用的 Dispatcher 查表分派，手勢對應的動作可在 actions.json 設定。
+#      11. 連線握手: 目前目標的實際音量一讀到就隨 HELLO 送出 (含靜音/麥克風狀態)，
+#          並從回覆得知韌體版本、支援的功能、LED 亮度與模式。
+#      12. 前景偵測加上防抖與 MRU 快取 (ForegroundTracker)，快速 Alt-Tab 不會反覆查詢與更新 LED。
+
+import time
+STARTUP_T0 = time.perf_counter()  # 啟動計時的起點，放在所有 import 之前
 
 import tkinter as tk
 from tkinter import ttk
-import serial
-import serial.tools.list_ports
 import threading
-import time
 import queue
-import comtypes
+from device_protocol import parse_frame, volume_step, StateSync
+from activity_scheduler import ActivityScheduler
+from trace_recorder import tracer
+from foreground_tracker import ForegroundTracker
+
+# --- 多旋鈕設定 ---
+# 通道 0 為主旋鈕 (自動偵測前景/手動鎖定)；其他通道固定控制指定的程式名稱，
+# 例如 {1: "Spotify.exe", 2: "Discord.exe"}。長按旋轉可切換該通道的目標。
+CHANNEL_TARGETS = {}
+
+# --- 群組控制設定 ---
+# "single": 只控制找到的第一個 session
+# "exe":    控制同一執行檔名稱的所有 session (瀏覽器、啟動器常會開很多個)
+# "tree":   控制前景程式本身及其所有子程序的 session (執行檔名稱不同也算)
+GROUP_MODE = "exe"
+
+# --- 前景偵測設定 ---
+# 前景視窗需停留多久 (秒) 才切換目標，短暫出現的視窗 (通知、Alt-Tab 途中) 會被忽略
+FOREGROUND_SETTLE = 0.25
+
+# --- 時間軸追蹤 ---
+# 設為檔名 (例如 "controller_trace.json") 即開啟追蹤，斷線或關閉視窗時寫出，
+# 可用 chrome://tracing 或 https://ui.perfetto.dev 開啟。None 表示關閉。
+TRACE_FILE = None
+
+# --- 啟動效能紀錄 ---
+# 從程式啟動起算，印出視窗出現、後端就緒、連線成功、收到第一個旋鈕指令的時間
+STARTUP_PROFILE = True
+startup_marks = {}
+
+def mark_startup(name):
+    if name in startup_marks: return
+    startup_marks[name] = time.perf_counter() - STARTUP_T0
+    tracer.mark(f"startup.{name}")
+    if STARTUP_PROFILE: print(f"[啟動] {name}: {startup_marks[name] * 1000:.0f} ms")
+
+def find_candidate_ports():
+    """列出所有 COM Port，描述符合 RP2040 等關鍵字的排在前面"""
+    import serial.tools.list_ports
+    ports_info = serial.tools.list_ports.comports()
+    keywords = ["RP2040", "CircuitPython", "Feather", "Pico", "USB Serial"]
+    ports_with_keyword = [p.device for p in ports_info if any(k.lower() in (p.description or "").lower() or k.lower() in (p.manufacturer or "").lower() for k in keywords)]
+    other_ports = [p.device for p in ports_info if p.device not in ports_with_keyword]
+    return ports_with_keyword + other_ports
 
 # --- 核心控制邏輯 (與前一版完全相同) ---
-def controller_thread_logic(port_list, status_queue, stop_event):
-    # ... (此處所有後端邏輯都與前一版相同，為節省篇幅省略) ...
+def controller_thread_logic(port_list, status_queue, stop_event, serial_factory=None):
+    # serial_factory: 預設為 serial.Serial，長時間測試 (soak_mode.py) 會換成模擬裝置
+    # 後端模組在這裡才載入 (與視窗建立同時進行)，第二次連線時已在快取中
+    import serial
+    import comtypes
+    from volume_writer import VolumeWriter, session_key
+    from serial_writer import SerialWriter
+    from command_dispatch import Dispatcher, load_action_map
     comtypes.CoInitialize()
+    volume_writer, serial_writer = VolumeWriter(), None
     try:
         from pycaw.pycaw import AudioUtilities, IAudioEndpointVolume
         from comtypes import CLSCTX_ALL
         from ctypes import cast, POINTER
         import win32gui, win32process, psutil
+        mark_startup("backend_ready")
 
         def log_message(message): status_queue.put(message)
 
@@ -30,15 +93,32 @@ def controller_thread_logic(port_list, status_queue, stop_event):
             mic_volume_control = cast(interface, POINTER(IAudioEndpointVolume))
         except Exception: pass
 
+        # 連線前先載入並檢查動作設定，設定檔有誤時直接顯示原因
+        try: action_map = load_action_map()
+        except ValueError as e:
+            log_message(f"CMD:{e}")
+            status_queue.put("STATUS:錯誤: actions.json 設定有誤")
+            status_queue.put("UI_STATE:disconnected")
+            return
+
+        if port_list is None:
+            # 自動模式: 由後端執行緒自行掃描，GUI 執行緒不必等待
+            port_list = find_candidate_ports()
+            if not port_list:
+                status_queue.put("STATUS:錯誤！找不到任何COM Port！")
+                status_queue.put("UI_STATE:disconnected")
+                return
+
         ser = None
         for port_to_try in port_list:
             if stop_event.is_set(): return
             log_message(f"CMD:正在嘗試連接到 {port_to_try}...")
             try:
-                ser = serial.Serial(port_to_try, 115200, timeout=0.1)
+                ser = (serial_factory or serial.Serial)(port_to_try, 115200, timeout=0.1)
                 log_message(f"CMD:成功連接到 {port_to_try}！")
                 status_queue.put(f"STATUS:已連接到 {port_to_try}")
                 status_queue.put("UI_STATE:connected")
+                mark_startup("connected")
                 break
             except serial.SerialException:
                 log_message(f"CMD:{port_to_try} 連接失敗...")
@@ -50,32 +130,188 @@ def controller_thread_logic(port_list, status_queue, stop_event):
             status_queue.put("UI_STATE:disconnected")
             return
 
+        # 寫入交給背景執行緒，裝置忙碌造成的寫入阻塞不會影響讀取旋鈕指令
+        serial_writer = SerialWriter(ser)
+        sync = StateSync(serial_writer)  # 第一次送出的狀態就是握手 HELLO，之後為 S/V 指令
+        if tracer.enabled: serial_writer.send("TRACE", b"TRACE:1\n")  # 請韌體一併回報時間軸事件
+
         POLL_INTERVAL, MIN_TIMEDIFF, MAX_TIMEDIFF, MIN_VOLUME_STEP, MAX_VOLUME_STEP = 0.2, 0.02, 0.2, 0.01, 0.10
+        scheduler = ActivityScheduler(active_interval=0.01)
         
         def get_all_sessions():
-            try: return [s for s in AudioUtilities.GetAllSessions() if s.Process]
-            except Exception: return []
+            with tracer.span("sessions.enumerate"):
+                try: found = [s for s in AudioUtilities.GetAllSessions() if s.Process]
+                except Exception: return []
+                # 識別碼與 Process 在列舉時一併取得並快取，之後組群組、轉動旋鈕都不必再呼叫 COM
+                for s in found: session_key(s)
+                return found
+        def find_sessions(proc_name):
+            found = []
+            for s in sessions:
+                try:
+                    if s.Process and s.Process.name() == proc_name: found.append(s)
+                except Exception: continue
+            return found if GROUP_MODE != "single" else found[:1]
+        def resolve_group(leader, root_pid=None):
+            """找出與 leader 同一群組的所有 session (leader 排第一)，只在目標改變時呼叫"""
+            if GROUP_MODE == "single": return [leader]
+            try:
+                if GROUP_MODE == "tree" and root_pid:
+                    pids = {root_pid} | {c.pid for c in psutil.Process(root_pid).children(recursive=True)}
+                    members = [s for s in sessions if s.Process.pid in pids]
+                else: members = find_sessions(leader.Process.name())
+            except Exception: members = []
+            return [leader] + [s for s in members if s is not leader]
+        def target_group(leader):
+            # 快取目前目標的群組，轉動旋鈕時不需重新掃描 session
+            key = (id(leader), id(sessions), group_root_pid)
+            if group_cache[0] != key: group_cache[:] = [key, resolve_group(leader, group_root_pid)]
+            return group_cache[1]
         def send_volume_to_mcu(ser, session):
             if not ser or not ser.is_open or not session: return
             try:
-                is_muted = session.SimpleAudioVolume.GetMute()
-                level = 0 if is_muted else int(session.SimpleAudioVolume.GetMasterVolume() * 100)
-                ser.write(f"V:{level}\n".encode('utf-8'))
-                log_message(f"GUI_LED_UPDATE:{level}")
+                # 寫入執行緒還沒讀到實際音量時不送 (讀到後由 on_refresh 補送)；
+                # 支援 STATE 的韌體收到完整狀態 (含麥克風)，舊韌體仍是 "V:<音量>"
+                if not sync.push(*volume_writer.state(session), last_mic_muted): return
+                log_message(f"GUI_LED_UPDATE:{volume_writer.level(session)}")
             except Exception: pass
 
-        sessions, current_index, is_locked, last_turn_time, last_poll_time = get_all_sessions(), None, False, 0, 0
+        def resolve_foreground(hwnd, pid):
+            """前景視窗 -> session 索引 (找不到為 None)，只在前景穩定且不在快取中時呼叫"""
+            with tracer.span("foreground.resolve"):
+                proc_name = psutil.Process(pid).name()
+                for i, s in enumerate(sessions):
+                    if s.Process and s.Process.name() == proc_name: return i
+                if GROUP_MODE == "tree":
+                    # 程序樹模式: 前景程式本身沒有 session 時，改找它的子程序
+                    child_pids = {c.pid for c in psutil.Process(pid).children(recursive=True)}
+                    for i, s in enumerate(sessions):
+                        if s.Process.pid in child_pids: return i
+                return None
+
+        sessions, current_index, is_locked, last_poll_time = get_all_sessions(), None, False, 0
+        foreground = ForegroundTracker(resolve_foreground, settle=FOREGROUND_SETTLE)
+        channel_targets, last_turn_times = dict(CHANNEL_TARGETS), {}
+        group_root_pid, group_cache = None, [None, []]
+
+        def target_members(channel):
+            """回傳此通道目前控制的 session 群組 (第一個為主要 session)，沒有目標時為空串列"""
+            if channel != 0: return find_sessions(channel_targets.get(channel))
+            if current_index is not None and sessions and current_index < len(sessions):
+                return target_group(sessions[current_index])
+            return []
+
+        # --- 動作處理函式 (由 Dispatcher 依 actions.json 查表呼叫) ---
+        def change_volume(command, direction):
+            # 整個群組一次更新目標值，實際的 COM 寫入由 volume_writer 在背景並行執行
+            members = target_members(command.channel)
+            if not members: return
+            current_time = time.monotonic()
+            time_diff = current_time - last_turn_times.get(command.channel, 0)
+            last_turn_times[command.channel] = current_time
+            step = volume_step(time_diff, command.count, MIN_TIMEDIFF, MAX_TIMEDIFF, MIN_VOLUME_STEP, MAX_VOLUME_STEP)
+            volume_writer.shift_volume(members, step * direction)
+            send_volume_to_mcu(ser, members[0])
+
+        def toggle_mute(command):
+            members = target_members(command.channel)
+            if not members: return
+            muted = volume_writer.toggle_group_mute(members)
+            log_message("CMD:Mute" if muted is None else "CMD:Muted" if muted else "CMD:Unmuted")
+            send_volume_to_mcu(ser, members[0])
+
+        def toggle_mic_mute(command):
+            if mic_volume_control:
+                try:
+                    is_mic_muted = mic_volume_control.GetMute()
+                    mic_volume_control.SetMute(not is_mic_muted, None)
+                    log_message("CMD:Microphone " + ("Unmuted" if is_mic_muted else "Muted"))
+                except Exception as e: log_message(f"CMD:控制麥克風失敗: {e}")
+            else: log_message("CMD:錯誤: 無法執行MIC_MUTE (未找到麥克風)")
+
+        def refresh_sessions():
+            """重新列舉 session；清單順序可能改變，主旋鈕的 current_index 依 session 識別碼重新對應"""
+            nonlocal sessions, current_index
+            fresh = get_all_sessions()
+            if current_index is not None and current_index < len(sessions):
+                key = session_key(sessions[current_index])
+                current_index = next((i for i, s in enumerate(fresh) if session_key(s) == key), None)
+            sessions = fresh
+            foreground.invalidate()
+
+        def switch_target(command, direction):
+            nonlocal current_index, is_locked, group_root_pid
+            if command.channel != 0:
+                # 其他旋鈕: 各自控制自己的目標程式，不影響主旋鈕的狀態
+                refresh_sessions()
+                names = []
+                for s in sessions:
+                    try:
+                        if s.Process.name() not in names: names.append(s.Process.name())
+                    except Exception: continue
+                if not names: return
+                name = channel_targets.get(command.channel)
+                index = names.index(name) if name in names else (-1 if direction > 0 else 0)
+                index = (index + command.count * direction) % len(names)
+                channel_targets[command.channel] = names[index]
+                log_message(f"CMD:[{command.channel}] 目標: {names[index]}")
+                members = find_sessions(names[index])
+                if members: send_volume_to_mcu(ser, members[0])
+                return
+            is_locked, group_root_pid = True, None
+            log_message("CMD:模式切換: 手動鎖定目標")
+            if not sessions: return
+            if current_index is None: current_index = -1 if direction > 0 else 0
+            current_index = (current_index + command.count * direction) % len(sessions)
+            refresh_sessions()
+            if current_index is not None: send_volume_to_mcu(ser, sessions[current_index])
+
+        def auto_target(command):
+            nonlocal is_locked, current_index
+            if command.channel != 0:
+                channel_targets[command.channel] = CHANNEL_TARGETS.get(command.channel)
+                return
+            is_locked, current_index = False, None
+            log_message("CMD:模式切換: 自動偵測前景")
+
+        def refresh_led(session):
+            """寫入執行緒讀到主旋鈕目標的實際音量 (或被外部改動) 時立即更新 LED，不必等下一次輪詢"""
+            try:
+                if current_index is not None and session_key(session) == session_key(sessions[current_index]): send_volume_to_mcu(ser, session)
+            except IndexError: pass
+        volume_writer.on_refresh = refresh_led
+
+        dispatcher = Dispatcher({
+            "volume_up": lambda command: change_volume(command, 1),
+            "volume_down": lambda command: change_volume(command, -1),
+            "mute": toggle_mute,
+            "mic_mute": toggle_mic_mute,
+            "next_target": lambda command: switch_target(command, 1),
+            "prev_target": lambda command: switch_target(command, -1),
+            "auto_target": auto_target,
+        }, action_map)
+
         log_message("CMD:控制器邏輯已啟動...")
+        last_target_name, last_mic_muted = None, None
 
         while not stop_event.is_set():
+            # 目標與麥克風狀態只在改變時才通知GUI
             target_name = "無"
             if current_index is not None and sessions and current_index < len(sessions):
                 try: target_name = sessions[current_index].Process.name()
                 except Exception: target_name = "已失效"
-            log_message(f"TARGET:{target_name}")
+            if target_name != last_target_name:
+                log_message(f"TARGET:{target_name}")
+                last_target_name = target_name
             
             if mic_volume_control:
-                try: log_message(f"MIC_STATUS:{mic_volume_control.GetMute()}")
+                try:
+                    with tracer.span("com.mic_status"): mic_muted = mic_volume_control.GetMute()
+                    if mic_muted != last_mic_muted:
+                        log_message(f"MIC_STATUS:{mic_muted}")
+                        last_mic_muted = mic_muted
+                        if "STATE" in sync.device.capabilities and current_index is not None and current_index < len(sessions):
+                            send_volume_to_mcu(ser, sessions[current_index])
                 except Exception: pass
 
             if time.time() - last_poll_time > POLL_INTERVAL:
@@ -84,71 +320,54 @@ def controller_thread_logic(port_list, status_queue, stop_event):
                     except IndexError: current_index = None
                 last_poll_time = time.time()
             if not is_locked:
-                try:
-                    hwnd, _, pid = win32gui.GetForegroundWindow(), *win32process.GetWindowThreadProcessId(win32gui.GetForegroundWindow())
-                    proc_name = psutil.Process(pid).name()
-                    found_match = False
-                    for i, s in enumerate(sessions):
-                        if s.Process and s.Process.name() == proc_name:
-                            if current_index != i:
-                               current_index = i
-                               send_volume_to_mcu(ser, s)
-                            found_match = True; break
-                    if not found_match: current_index = None
-                except Exception: current_index = None
+                with tracer.span("foreground"):
+                    try:
+                        hwnd = win32gui.GetForegroundWindow()
+                        _, pid = win32process.GetWindowThreadProcessId(hwnd)
+                        scheduler.foreground(hwnd)
+                        # 只有停留夠久的前景才會改變目標；常用程式的對應由快取取得
+                        index = foreground.update(hwnd, pid)
+                        group_root_pid = foreground.current[1]
+                        if index != current_index:
+                            current_index = index
+                            if index is not None: send_volume_to_mcu(ser, sessions[index])
+                    except Exception: current_index = None
+
+            # 連線握手: 有目標時等它的實際音量讀到 (由 on_refresh 隨 HELLO 送出)；沒有目標或讀取逾時才以空狀態握手
+            sync.hello_if_idle(current_index is not None, last_mic_muted)
             
-            line = ""
             try:
-                if ser.in_waiting > 0: line = ser.readline().decode('utf-8').strip()
+                # 以排程器的間隔等待指令 (閒置時為低頻心跳，收到資料立即返回)
+                with tracer.span("serial.read"): line = scheduler.read_line(ser).decode('utf-8').strip()
             except (serial.SerialException, OSError):
                 log_message("CMD:讀取序列埠時發生錯誤，連線已中斷。")
                 status_queue.put("UI_STATE:disconnected")
                 break
-            if not line:
-                time.sleep(0.01)
+            if not line: continue
+            if line.startswith("T:"):
+                tracer.device_line(line, time.perf_counter_ns())  # 韌體回報的時間軸事件
+                continue
+            device = sync.handle_line(line)
+            if device:
+                log_message(f"CMD:韌體 {device.firmware} (協定 {device.protocol}) 功能: {','.join(sorted(device.capabilities)) or '無'} "
+                            f"亮度: {device.brightness}% 模式: {device.mode}")
                 continue
             
-            command = line
+            command = parse_frame(line)
+            tracer.mark("command", line=line)
             
-            if command == "MUTE": pass
-            else: log_message(f"CMD:{command}")
+            if command.name == "MUTE": pass
+            else: log_message(f"CMD:{command.name}" if command.channel == 0 else f"CMD:[{command.channel}] {command.name}")
             
-            if command == "MIC_MUTE":
-                if mic_volume_control:
-                    try:
-                        is_mic_muted = mic_volume_control.GetMute()
-                        mic_volume_control.SetMute(not is_mic_muted, None)
-                        log_message("CMD:Microphone " + ("Unmuted" if is_mic_muted else "Muted"))
-                    except Exception as e: log_message(f"CMD:控制麥克風失敗: {e}")
-                else: log_message("CMD:錯誤: 無法執行MIC_MUTE (未找到麥克風)")
-            elif command == "UNLOCK": is_locked, current_index = False, None; log_message("CMD:模式切換: 自動偵測前景")
-            elif command in ["NEXT_APP", "PREV_APP"]:
-                is_locked = True
-                log_message("CMD:模式切換: 手動鎖定目標")
-                if not sessions: continue
-                if current_index is None: current_index = -1 if command == "NEXT_APP" else 0
-                if command == "NEXT_APP": current_index = (current_index + 1) % len(sessions)
-                else: current_index = (current_index - 1 + len(sessions)) % len(sessions)
-                sessions = get_all_sessions()
-                if sessions and current_index < len(sessions): send_volume_to_mcu(ser, sessions[current_index])
-            elif current_index is not None and sessions and current_index < len(sessions):
-                try:
-                    target_session, vol = sessions[current_index], sessions[current_index].SimpleAudioVolume
-                    if command == "UP" or command == "DOWN":
-                        current_time, time_diff = time.monotonic(), time.monotonic() - last_turn_time
-                        last_turn_time = current_time
-                        clamped_diff = max(MIN_TIMEDIFF, min(time_diff, MAX_TIMEDIFF))
-                        speed_ratio = (MAX_TIMEDIFF - clamped_diff) / (MAX_TIMEDIFF - MIN_TIMEDIFF)
-                        step = MIN_VOLUME_STEP + (MAX_VOLUME_STEP - MIN_VOLUME_STEP) * speed_ratio
-                        if command == "UP": vol.SetMasterVolume(min(1.0, vol.GetMasterVolume() + step), None)
-                        else: vol.SetMasterVolume(max(0.0, vol.GetMasterVolume() - step), None)
-                    elif command == "MUTE":
-                        is_currently_muted = vol.GetMute()
-                        vol.SetMute(not is_currently_muted, None)
-                        log_message("CMD:Unmuted" if is_currently_muted else "CMD:Muted")
-                    send_volume_to_mcu(ser, target_session)
-                except (IndexError, AttributeError): current_index = None
+            try: dispatcher.dispatch(command)
+            except (IndexError, AttributeError):
+                if command.channel == 0: current_index = None
+            # 第一次旋鈕指令處理完成 (音量已交給寫入器、LED 狀態已排入送出) 才算回應
+            mark_startup("first_knob")
     finally:
+        volume_writer.stop()
+        if serial_writer: serial_writer.stop()
+        if TRACE_FILE: tracer.dump(TRACE_FILE)
         comtypes.CoUninitialize()
 
 # --- GUI 應用程式類別 (更新，加入隱藏式手動控制) ---
@@ -213,10 +432,17 @@ class App(tk.Tk):
         
         self.led_canvas.bind("<Configure>", self.redraw_leds)
         self.protocol("WM_DELETE_WINDOW", self.on_closing)
+        self.queue_interval = 100
+        self.bind("<Map>", self.on_first_map)
         self.process_queue()
-        self.after(500, self.auto_connect_all_ports)
+        self.auto_connect_all_ports()  # 不再固定等待，後端執行緒會自行掃描連接埠
         self.after(5000, self.monitor_connection)
 
+    def on_first_map(self, event):
+        if event.widget is not self: return
+        self.unbind("<Map>")
+        self.after_idle(mark_startup, "window")
+
     def toggle_manual_controls(self):
         """顯示或隱藏手動控制項"""
         if self.manual_controls_frame.winfo_viewable():
@@ -226,6 +452,7 @@ class App(tk.Tk):
             self.update_com_ports()
 
     def update_com_ports(self):
+        import serial.tools.list_ports
         ports = [p.device for p in serial.tools.list_ports.comports()]
         self.port_selector['values'] = ports
         if ports: self.port_var.set(ports[0])
@@ -243,15 +470,8 @@ class App(tk.Tk):
 
     def auto_connect_all_ports(self):
         if self.thread and self.thread.is_alive(): return
-        ports_info = serial.tools.list_ports.comports()
-        if not ports_info:
-            self.status_label_var.set("狀態: 錯誤！找不到任何COM Port！")
-            return
-        keywords = ["RP2040", "CircuitPython", "Feather", "Pico", "USB Serial"]
-        ports_with_keyword = [p.device for p in ports_info if any(k.lower() in p.description.lower() or k.lower() in p.manufacturer.lower() for k in keywords)]
-        other_ports = [p.device for p in ports_info if p.device not in ports_with_keyword]
         self.status_label_var.set("狀態: 開始自動掃描連接...")
-        self.start_controller_thread(ports_with_keyword + other_ports)
+        self.start_controller_thread(None)  # None: 由後端執行緒掃描並依序嘗試
 
     def start_controller_thread(self, port_list):
         self.stop_event.clear()
@@ -283,13 +503,25 @@ class App(tk.Tk):
 
     def on_closing(self):
         self.is_intentionally_stopped = True
-        if self.thread and self.thread.is_alive(): self.stop_event.set()
+        if self.thread and self.thread.is_alive():
+            # 先等控制執行緒收尾 (讀取逾時最長約 1 秒)，它寫完追蹤檔後這裡再寫入包含視窗事件的完整版本
+            self.stop_event.set()
+            self.thread.join(timeout=3)
+        if TRACE_FILE: tracer.dump(TRACE_FILE)
         self.destroy()
         
     def process_queue(self):
+        with tracer.span("tk.process_queue"): handled = self._drain_status_queue()
+        # 有訊息時每 100ms 檢查一次，佇列持續空著就逐步放慢，但最多 250ms (閒置後第一次轉動旋鈕的畫面延遲)
+        self.queue_interval = 100 if handled else min(self.queue_interval * 2, 250)
+        self.after(self.queue_interval, self.process_queue)
+
+    def _drain_status_queue(self):
+        handled = False
         try:
             while True:
                 message = self.status_queue.get_nowait()
+                handled = True
                 if message.startswith("GUI_LED_UPDATE:"): self.update_gui_leds(int(message.split(":")[1]))
                 elif message.startswith("CMD:"): self.last_command_var.set(message[4:])
                 elif message.startswith("TARGET:"):
@@ -308,7 +540,7 @@ class App(tk.Tk):
                 elif message.startswith("UI_STATE:"):
                     self.set_ui_state(message.split(":")[1])
         except (queue.Empty, ValueError, IndexError): pass
-        self.after(100, self.process_queue)
+        return handled
 
     # (redraw_leds, update_gui_leds 與前一版相同)
     def redraw_leds(self, event=None):
@@ -321,6 +553,9 @@ class App(tk.Tk):
             self.led_canvas.coords(rect_id, x0, y0, x1, y1)
             
     def update_gui_leds(self, level):
+        with tracer.span("tk.leds", level=level): self._draw_gui_leds(level)
+
+    def _draw_gui_leds(self, level):
         self.volume_var.set(f"音量: {level}%")
         num_pixels, leds_to_light = 15, round(level / 100 * 15)
         for i, rect_id in enumerate(self.led_rects):
@@ -332,5 +567,6 @@ class App(tk.Tk):
             self.led_canvas.itemconfig(rect_id, fill=color)
 
 if __name__ == "__main__":
+    if TRACE_FILE: tracer.enable()
     app = App()
     app.mainloop()
\ No newline at end of file
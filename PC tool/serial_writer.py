@@ -0,0 +1,43 @@
+# serial_writer.py - 非阻塞序列埠寫入器
+# 功能: 1. 所有送往 RP2040 的資料交給專屬的寫入執行緒，主迴圈呼叫 send() 立即返回。
+#       2. 待送佇列依「種類」合併: 同一種類 (例如 LED 音量 "V") 尚未送出時，
+#          新的內容直接取代舊的，裝置忙碌 (例如 LED 閃爍的 sleep) 時佇列也不會累積。
+#       3. 寫入被 USB CDC 緩衝區卡住時只有寫入執行緒在等待，不影響讀取旋鈕指令。
+
+import threading
+from trace_recorder import tracer
+
+class SerialWriter:
+    def __init__(self, ser):
+        self.ser = ser
+        self.error = None            # 寫入失敗時記錄例外，之後的 send() 直接忽略
+        self._pending = {}           # 種類 -> bytes，dict 保留第一次加入的順序
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="SerialWriter", daemon=True)
+        self._thread.start()
+
+    def send(self, kind, data):
+        """排入一筆資料；同種類尚未送出的舊資料會被取代"""
+        with self._cond:
+            if self._stopped or self.error: return
+            self._pending[kind] = data
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped: self._cond.wait()
+                if self._stopped: return
+                batch, self._pending = b"".join(self._pending.values()), {}
+            try:
+                with tracer.span("serial.write", size=len(batch)): self.ser.write(batch)
+            except Exception as e:
+                # 連線中斷: 交由讀取端偵測並處理斷線
+                with self._cond: self.error = e
+                return
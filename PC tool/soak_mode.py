@@ -0,0 +1,206 @@
+# soak_mode.py - 長時間穩定性測試 (soak test)
+# 功能: 1. 以模擬的 RP2040 (隨機產生或重播錄製的指令) 加速驅動 gui_volume_controller
+#          的控制邏輯數小時，使用真實的 pycaw / win32 / psutil 後端。
+#       2. 定期取樣記憶體配置 (tracemalloc)、Python 物件數量、系統 handle 數、
+#          執行緒數與 status_queue 深度。
+#       3. 成長超過預算時判定失敗，並列出配置記憶體最多的程式位置。
+#
+#   注意: 測試期間會真的調整前景/目標程式的音量與靜音，請先播放測試用的聲音。
+#   用法: python soak_mode.py  (參數請直接修改下方設定)
+
+import gc
+import queue
+import random
+import threading
+import time
+import tracemalloc
+from gui_volume_controller import controller_thread_logic
+
+# --- 設定 ---
+SOAK_HOURS = 4.0            # 要模擬的使用時間 (小時)
+SPEED = 20.0                # 加速倍率: 指令間隔除以此數 (4 小時 / 20 = 實際跑 12 分鐘)
+REPLAY_FILE = None          # 錄製檔，每行 "<相對開始的秒數> <指令>"，None 表示隨機產生
+RANDOM_SEED = 0
+WARMUP_S = 30.0             # 暖機多久後才取基準值 (實際秒數)
+SAMPLE_INTERVAL = 10.0      # 取樣間隔 (實際秒數)
+QUEUE_DRAIN_INTERVAL = 0.1  # 模擬 GUI 每 100ms 清空一次 status_queue
+REPORT_FILE = "soak_report.txt"
+TOP_ALLOCATIONS = 15
+
+# --- 成長預算 (結束值 - 基準值) ---
+HEAP_BUDGET_KB = 2048
+OBJECT_BUDGET = 20000
+HANDLE_BUDGET = 100
+THREAD_BUDGET = 10
+QUEUE_DEPTH_BUDGET = 500    # status_queue 任一次取樣的最大深度
+
+def random_frames(seed):
+    """模擬真人操作，產生 (距離上一個指令的秒數, 指令)"""
+    rng = random.Random(seed)
+    while True:
+        r = rng.random()
+        if r < 0.85:
+            # 一段連續旋轉，速度有快有慢
+            command = rng.choice(["UP", "DOWN"])
+            for _ in range(rng.randint(1, 15)):
+                yield rng.uniform(0.02, 0.2), f"0:{command}:{rng.randint(1, 2)}"
+            yield rng.uniform(0.5, 5.0), f"0:{command}:1"
+        elif r < 0.92:
+            # 靜音再取消，測試結束後維持原狀
+            yield rng.uniform(0.5, 3.0), "0:MUTE"
+            yield rng.uniform(0.5, 3.0), "0:MUTE"
+        elif r < 0.97:
+            # 長按切換目標後解鎖
+            for _ in range(rng.randint(1, 4)):
+                yield rng.uniform(0.2, 1.0), rng.choice(["0:NEXT_APP:1", "0:PREV_APP:1"])
+            yield rng.uniform(1.0, 3.0), "0:UNLOCK"
+        else:
+            yield rng.uniform(5.0, 60.0), "0:UP:1"  # 長時間沒碰旋鈕
+
+def replay_frames(path):
+    """重複播放錄製檔，產生 (距離上一個指令的秒數, 指令)"""
+    with open(path, encoding="utf-8") as f:
+        records = []
+        for raw in f:
+            parts = raw.strip().split(None, 1)
+            if len(parts) == 2: records.append((float(parts[0]), parts[1]))
+    if not records: raise ValueError(f"{path} 沒有任何指令")
+    while True:
+        previous = 0.0
+        for timestamp, line in records:
+            yield max(0.0, timestamp - previous), line
+            previous = timestamp
+
+class SimulatedDevice:
+    """假裝成 serial.Serial 的 RP2040: 依時間吐出指令，寫入的 LED 指令只計數"""
+    def __init__(self, frames, speed):
+        self.frames, self.speed = frames, speed
+        self.timeout, self.is_open = 0.1, True
+        self.frames_sent, self.bytes_written, self.simulated_seconds = 0, 0, 0.0
+        self._next = None
+
+    def _peek(self):
+        if self._next is None:
+            gap, line = next(self.frames)
+            self.simulated_seconds += gap
+            self._next = (time.monotonic() + gap / self.speed, line)
+        return self._next
+
+    @property
+    def in_waiting(self):
+        return 1 if self._peek()[0] <= time.monotonic() else 0
+
+    def readline(self):
+        due, line = self._peek()
+        wait = due - time.monotonic()
+        if wait > 0:
+            if self.timeout is not None and wait > self.timeout:
+                time.sleep(self.timeout)
+                return b""
+            time.sleep(wait)
+        self._next = None
+        self.frames_sent += 1
+        return (line + "\n").encode("utf-8")
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        return len(data)
+
+    def close(self):
+        self.is_open = False
+
+def count_handles():
+    try:
+        import psutil
+        process = psutil.Process()
+        return process.num_handles() if hasattr(process, "num_handles") else process.num_fds()
+    except Exception: return 0
+
+def take_sample(status_queue, max_depth):
+    gc.collect()
+    heap, _ = tracemalloc.get_traced_memory()
+    return {"time": time.monotonic(), "heap_kb": heap / 1024, "objects": len(gc.get_objects()),
+            "handles": count_handles(), "threads": threading.active_count(),
+            "queue_depth": max_depth, "queue_now": status_queue.qsize()}
+
+def main():
+    frames = replay_frames(REPLAY_FILE) if REPLAY_FILE else random_frames(RANDOM_SEED)
+    device = SimulatedDevice(frames, SPEED)
+    status_queue, stop_event = queue.Queue(), threading.Event()
+    wall_duration = SOAK_HOURS * 3600 / SPEED
+    print(f"--- Soak 測試: 模擬 {SOAK_HOURS} 小時，{SPEED}x 加速，預計 {wall_duration / 60:.1f} 分鐘 ---")
+
+    tracemalloc.start(10)
+    thread = threading.Thread(target=controller_thread_logic, args=(["SIMULATED"], status_queue, stop_event, lambda *a, **k: device), daemon=True)
+    thread.start()
+
+    samples, baseline_snapshot, messages, max_depth = [], None, 0, 0
+    start = time.monotonic()
+    next_sample = start + WARMUP_S
+    try:
+        while thread.is_alive() and time.monotonic() - start < wall_duration:
+            # 模擬 GUI 的 process_queue: 記錄深度後全部取出
+            max_depth = max(max_depth, status_queue.qsize())
+            try:
+                while True:
+                    status_queue.get_nowait()
+                    messages += 1
+            except queue.Empty: pass
+            if time.monotonic() >= next_sample:
+                sample = take_sample(status_queue, max_depth)
+                sample["messages"], sample["simulated_h"] = messages, device.simulated_seconds / 3600
+                samples.append(sample)
+                if baseline_snapshot is None: baseline_snapshot = tracemalloc.take_snapshot()
+                print(f"[{sample['simulated_h']:6.2f}h] heap {sample['heap_kb']:9.1f} KB  objects {sample['objects']:7d}  "
+                      f"handles {sample['handles']:5d}  threads {sample['threads']:3d}  queue max {max_depth:4d}  msgs {messages}")
+                max_depth, next_sample = 0, time.monotonic() + SAMPLE_INTERVAL
+            time.sleep(QUEUE_DRAIN_INTERVAL)
+    except KeyboardInterrupt:
+        print("\n使用者中斷，以目前資料產生報告。")
+    finally:
+        stop_event.set()
+        thread.join(timeout=5)
+
+    if len(samples) < 2:
+        print("錯誤: 取樣數不足 (控制邏輯提早結束或測試時間太短)。")
+        return 1
+    final_snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    return write_report(samples, baseline_snapshot, final_snapshot, device)
+
+def write_report(samples, baseline_snapshot, final_snapshot, device):
+    base, last = samples[0], samples[-1]
+    checks = [("heap (KB)", last["heap_kb"] - base["heap_kb"], HEAP_BUDGET_KB),
+              ("objects", last["objects"] - base["objects"], OBJECT_BUDGET),
+              ("handles", last["handles"] - base["handles"], HANDLE_BUDGET),
+              ("threads", last["threads"] - base["threads"], THREAD_BUDGET),
+              ("queue depth (max)", max(s["queue_depth"] for s in samples), QUEUE_DEPTH_BUDGET)]
+    failed = [name for name, growth, budget in checks if growth > budget]
+    elapsed_h = (last["time"] - base["time"]) / 3600
+
+    lines = ["=== Soak 測試報告 ===",
+             f"模擬時間: {last['simulated_h']:.2f} 小時  實際時間: {elapsed_h * 60:.1f} 分鐘  "
+             f"指令: {device.frames_sent}  LED 寫入: {device.bytes_written} bytes  GUI 訊息: {last['messages']}",
+             "", "項目                 成長值      預算    結果"]
+    for name, growth, budget in checks:
+        lines.append(f"{name:<18} {growth:>10.1f} {budget:>9}    {'FAIL' if growth > budget else 'ok'}")
+    lines += ["", f"--- 記憶體成長最多的配置位置 (前 {TOP_ALLOCATIONS} 名) ---"]
+    # compare_to 依變化量的絕對值排序，縮小的位置可能排在成長的前面，因此先篩出成長的再排序
+    stats = [s for s in final_snapshot.compare_to(baseline_snapshot, "traceback") if s.size_diff > 0]
+    stats.sort(key=lambda s: s.size_diff, reverse=True)
+    for stat in stats[:TOP_ALLOCATIONS]:
+        lines.append(f"{stat.size_diff / 1024:+.1f} KB ({stat.count_diff:+d} 個區塊)")
+        for frame_line in stat.traceback.format(limit=4, most_recent_first=True): lines.append("    " + frame_line.strip())
+    lines += ["", "--- 取樣紀錄 ---", "模擬小時  heap(KB)  objects  handles  threads  queue_max"]
+    for s in samples:
+        lines.append(f"{s['simulated_h']:8.2f} {s['heap_kb']:9.1f} {s['objects']:8d} {s['handles']:8d} {s['threads']:8d} {s['queue_depth']:10d}")
+    lines += ["", "結果: " + (f"FAIL ({', '.join(failed)})" if failed else "PASS")]
+
+    report = "\n".join(lines)
+    print("\n" + report)
+    with open(REPORT_FILE, "w", encoding="utf-8") as f: f.write(report + "\n")
+    print(f"\n報告已寫入 {REPORT_FILE}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
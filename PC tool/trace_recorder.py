@@ -0,0 +1,97 @@
+# trace_recorder.py - 時間軸追蹤紀錄 (預設關閉)
+# 功能: 1. 以 with tracer.span("名稱"): 記錄各執行緒上每段工作的開始/結束時間，
+#          存放在固定大小的環狀緩衝區，長時間執行也不會無限成長。
+#       2. 韌體開啟追蹤後會送出 "T:<開始ms>:<長度ms>:<名稱>"，這些事件會對齊到
+#          主機的時間軸上 (取「接收時間 - 裝置時間」的最小值作為時鐘偏移)。
+#       3. dump() 輸出 Chrome Trace Event 格式的 JSON，可用 chrome://tracing 或
+#          https://ui.perfetto.dev 開啟。先寫入暫存檔再整個取代，寫到一半被中斷也不會留下壞檔。
+
+import collections
+import os
+import threading
+import time
+
+TRACE_CAPACITY = 200000          # 環狀緩衝區最多保留的事件數
+DEVICE_TICKS_PERIOD = 1 << 29    # 韌體 ticks_ms 的回捲週期
+
+class _NullSpan:
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    __slots__ = ("events", "name", "args", "start")
+    def __init__(self, events, name, args):
+        self.events, self.name, self.args = events, name, args
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        self.events.append((self.name, self.start, end - self.start, threading.get_ident(), self.args))
+        return False
+
+class TraceRecorder:
+    def __init__(self, capacity=TRACE_CAPACITY):
+        self.enabled = False
+        self._events = collections.deque(maxlen=capacity)   # deque.append 本身是執行緒安全的
+        self._device_events = collections.deque(maxlen=capacity)
+        self._thread_names = {}
+        self._device_offset = None
+        self._device_last, self._device_wraps = None, 0
+        self._dump_lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def span(self, name, **args):
+        """回傳記錄一段工作的 context manager；未啟用時回傳共用的空物件，幾乎沒有成本"""
+        if not self.enabled: return _NULL_SPAN
+        ident = threading.get_ident()
+        if ident not in self._thread_names: self._thread_names[ident] = threading.current_thread().name
+        return _Span(self._events, name, args)
+
+    def mark(self, name, **args):
+        """記錄一個瞬間事件 (長度為 0)"""
+        if not self.enabled: return
+        with self.span(name, **args): pass
+
+    def device_line(self, line, recv_ns):
+        """解析韌體的追蹤行 "T:<開始ms>:<長度ms>:<名稱>"，recv_ns 為主機收到該行的 perf_counter_ns"""
+        if not self.enabled: return
+        try:
+            _, start, duration, name = line.split(":", 3)
+            start, duration = int(start), int(duration)
+        except ValueError: return
+        # ticks_ms 約 6.2 天回捲一次，展開成連續的毫秒數
+        if self._device_last is not None and start < self._device_last - DEVICE_TICKS_PERIOD // 2:
+            self._device_wraps += 1
+        self._device_last = start
+        start += self._device_wraps * DEVICE_TICKS_PERIOD
+        # 傳輸延遲只會讓差值變大，因此最小值最接近真正的時鐘偏移
+        offset = recv_ns - (start + duration) * 1_000_000
+        if self._device_offset is None or offset < self._device_offset: self._device_offset = offset
+        self._device_events.append((name, start, duration))
+
+    def dump(self, path):
+        """將目前緩衝區內容寫成 Chrome Trace Event JSON 檔"""
+        import json  # 只有輸出時才需要，不拖慢程式啟動
+        events = [{"name": "process_name", "ph": "M", "pid": 1, "args": {"name": "PC controller"}},
+                  {"name": "process_name", "ph": "M", "pid": 2, "args": {"name": "RP2040"}}]
+        for ident, thread_name in list(self._thread_names.items()):
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": ident, "args": {"name": thread_name}})
+        for name, start, duration, ident, args in list(self._events):
+            events.append({"name": name, "ph": "X", "ts": start / 1000, "dur": duration / 1000, "pid": 1, "tid": ident, "args": args})
+        if self._device_offset is not None:
+            for name, start, duration in list(self._device_events):
+                events.append({"name": name, "ph": "X", "ts": (start * 1_000_000 + self._device_offset) / 1000,
+                               "dur": duration * 1000, "pid": 2, "tid": 0})
+        with self._dump_lock:
+            temp_path = path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+            os.replace(temp_path, path)
+
+# 全域共用的紀錄器，各模組直接 import 使用
+tracer = TraceRecorder()
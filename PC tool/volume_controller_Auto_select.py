@@ -1,6 +1,13 @@
 # volume_controller.py - 最終穩定版 (採用Process Name比對)
 # 功能: 1. 自動偵測採更可靠的「程式名稱」比對，大幅提高成功率。
 #       2. 保留並最佳化所有已有功能（手動鎖定、動態加速度、LED回饋）。
+#       3. 支援多旋鈕韌體: 通道 0 沿用原本邏輯，其他通道各自控制 CHANNEL_TARGETS 中的程式。
+#       4. 音量寫入交給背景寫入器，慢速程式的 COM 呼叫不會卡住指令迴圈。
+#       5. 閒置時把讀取逾時 (也就是重新列舉 session 的頻率) 從 0.2 秒放慢到 2 秒。
+#       6. LED 音量由背景寫入執行緒送出，只保留最新一筆，裝置忙碌時不會卡住讀取。
+#       7. 指令由共用的 Dispatcher 查表分派，手勢對應的動作可在 actions.json 設定。
+#       8. 連線後以 HELLO 握手 (帶前景目標的實際音量) 同步 LED，並依韌體支援的功能選擇 LED 指令格式。
+#       9. 前景偵測加上防抖與 MRU 快取，只有停留夠久的前景才會切換目標並更新 LED。
 
 import os
 import time
@@ -9,6 +16,12 @@ from pycaw.pycaw import AudioUtilities
 import win32gui
 import win32process
 import psutil
+from device_protocol import parse_frame, volume_step, StateSync
+from volume_writer import VolumeWriter, session_key
+from activity_scheduler import ActivityScheduler
+from serial_writer import SerialWriter
+from command_dispatch import Dispatcher, load_action_map
+from foreground_tracker import ForegroundTracker
 
 # --- 設定 ---
 SERIAL_PORT = 'COM8'
@@ -20,18 +33,40 @@ MAX_TIMEDIFF = 0.2
 MIN_VOLUME_STEP = 0.01
 MAX_VOLUME_STEP = 0.10
 
+# --- 閒置降頻設定 ---
+ACTIVE_READ_TIMEOUT = 0.2  # 使用中: 每 0.2 秒沒有指令就重新列舉 session
+IDLE_READ_TIMEOUT = 2.0    # 閒置時的心跳間隔
+IDLE_AFTER = 30.0          # 旋鈕與前景都沒變化多久後進入閒置
+
+# --- 前景偵測設定 ---
+FOREGROUND_SETTLE = 0.25   # 前景視窗需停留多久 (秒) 才切換目標，實際反應以讀取逾時為單位
+
+# --- 多旋鈕設定 ---
+# 通道 0 為主旋鈕；其他通道固定控制的程式名稱，例如 {1: "Spotify.exe"}
+CHANNEL_TARGETS = {}
+
+# 背景音量寫入器: 旋鈕只更新目標值，由寫入執行緒以限定頻率套用
+volume_writer = VolumeWriter()
+
 # --- 核心函式 ---
 def get_all_sessions():
     sessions = AudioUtilities.GetAllSessions()
     return [s for s in sessions if s.Process]
 
-def send_volume_to_mcu(ser, session):
-    if not ser or not ser.is_open or not session:
+def find_session(sessions, proc_name):
+    for session in sessions:
+        try:
+            if session.Process and session.Process.name() == proc_name:
+                return session
+        except Exception:
+            continue
+    return None
+
+def send_volume_to_mcu(sync, session):
+    if not sync or not session:
         return
     try:
-        is_muted = session.SimpleAudioVolume.GetMute()
-        level = 0 if is_muted else int(session.SimpleAudioVolume.GetMasterVolume() * 100)
-        ser.write(f"V:{level}\n".encode('utf-8'))
+        sync.push(*volume_writer.state(session))  # 寫入執行緒還沒讀到實際音量時不送
     except Exception:
         pass
 
@@ -54,9 +89,11 @@ def print_status(sessions, current_index, port_name, is_locked, debug_info):
         for i, session in enumerate(sessions):
             try:
                 prefix = ">> " if i == current_index else "   "
-                volume_percent = f"{session.SimpleAudioVolume.GetMasterVolume():.0%}"
-                mute_status = " [靜音]" if session.SimpleAudioVolume.GetMute() else ""
-                print(f"{prefix}[{i}] {session.Process.name()} (PID: {session.Process.id}) @ {volume_percent}{mute_status}")
+                # 只顯示寫入器快取的狀態，主迴圈不呼叫 COM (還沒讀到的顯示為 ?)
+                volume, muted = volume_writer.peek(session)
+                volume_percent = "?" if volume is None else f"{volume:.0%}"
+                mute_status = " [靜音]" if muted else ""
+                print(f"{prefix}[{i}] {session.Process.name()} (PID: {session.Process.pid}) @ {volume_percent}{mute_status}")
             except Exception: continue
 
     print("\n--- 除錯資訊 ---")
@@ -64,20 +101,110 @@ def print_status(sessions, current_index, port_name, is_locked, debug_info):
     print("--------------------")
 
 def main():
-    ser = None
+    ser, writer = None, None
+    # 連線前先載入並檢查動作設定
+    try: action_map = load_action_map()
+    except ValueError as e:
+        print(f"錯誤：{e}")
+        return
+
     try:
-        ser = serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=0.2)
-        print(f"成功連接到 {SERIAL_PORT}！")
-        time.sleep(1)
+        ser = serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=ACTIVE_READ_TIMEOUT)
     except serial.SerialException as e:
         print(f"錯誤：無法開啟序列埠 {SERIAL_PORT}。詳細錯誤: {e}")
         return
 
+    # 連線握手: 背景讀到前景目標的實際音量後立即以 HELLO 送出 (CircuitPython 的 USB CDC 開啟時不會重新開機，不必等待)；
+    # 沒有目標或讀取逾時就先以空狀態握手。此版本不管理麥克風，麥克風欄位送 "-"
+    writer = SerialWriter(ser)
+    sync = StateSync(writer)
+    print(f"成功連接到 {SERIAL_PORT}！")
     sessions = get_all_sessions()
     current_index = None
     is_locked = False
     debug_info = {}
-    last_turn_time = 0
+    channel_targets = dict(CHANNEL_TARGETS)
+    last_turn_times = {}
+    scheduler = ActivityScheduler(ACTIVE_READ_TIMEOUT, IDLE_READ_TIMEOUT, IDLE_AFTER)
+
+    def resolve_foreground(hwnd, pid):
+        """前景視窗 -> (session 索引 或 None, 程式名稱)，只在前景穩定且不在快取中時呼叫"""
+        proc_name = psutil.Process(pid).name()
+        for i, session in enumerate(sessions):
+            if session.Process and session.Process.name() == proc_name:
+                return i, proc_name
+        return None, proc_name
+
+    foreground = ForegroundTracker(resolve_foreground, settle=FOREGROUND_SETTLE)
+
+    def target_session(channel):
+        if channel != 0:
+            return find_session(sessions, channel_targets.get(channel))
+        if current_index is not None and sessions and current_index < len(sessions):
+            return sessions[current_index]
+        return None
+
+    # --- 動作處理函式 (由 Dispatcher 依 actions.json 查表呼叫) ---
+    def change_volume(command, direction):
+        session = target_session(command.channel)
+        if not session: return
+        current_time = time.monotonic()
+        time_diff = current_time - last_turn_times.get(command.channel, 0)
+        last_turn_times[command.channel] = current_time
+        step = volume_step(time_diff, command.count, MIN_TIMEDIFF, MAX_TIMEDIFF, MIN_VOLUME_STEP, MAX_VOLUME_STEP)
+        # 相對調整: 實際音量還沒讀到時由寫入執行緒讀到後再套用，主迴圈不呼叫 COM
+        volume_writer.shift_volume([session], step * direction)
+        send_volume_to_mcu(sync, session)
+
+    def toggle_mute(command):
+        session = target_session(command.channel)
+        if not session: return
+        volume_writer.toggle_group_mute([session])
+        send_volume_to_mcu(sync, session)
+
+    def switch_target(command, direction):
+        nonlocal current_index, is_locked
+        if command.channel != 0:
+            # 其他旋鈕: 依程式名稱切換該通道的目標
+            names = []
+            for session in sessions:
+                try:
+                    if session.Process.name() not in names: names.append(session.Process.name())
+                except Exception: continue
+            if not names: return
+            name = channel_targets.get(command.channel)
+            index = names.index(name) if name in names else (-1 if direction > 0 else 0)
+            channel_targets[command.channel] = names[(index + command.count * direction) % len(names)]
+        else:
+            is_locked = True
+            if not sessions: return
+            if current_index is None: current_index = -1 if direction > 0 else 0
+            current_index = (current_index + command.count * direction) % len(sessions)
+        send_volume_to_mcu(sync, target_session(command.channel))
+
+    def auto_target(command):
+        nonlocal current_index, is_locked
+        if command.channel != 0:
+            channel_targets[command.channel] = CHANNEL_TARGETS.get(command.channel)
+        else:
+            is_locked = False
+            current_index = None
+
+    # 背景讀到主旋鈕目標的實際音量 (或被外部改動) 時更新 LED
+    # (session 清單每次逾時都會重建，因此以識別碼比對而不是物件本身)
+    def refresh_led(session):
+        target = target_session(0)
+        if target and session_key(session) == session_key(target): send_volume_to_mcu(sync, session)
+    volume_writer.on_refresh = refresh_led
+
+    dispatcher = Dispatcher({
+        "volume_up": lambda command: change_volume(command, 1),
+        "volume_down": lambda command: change_volume(command, -1),
+        "mute": toggle_mute,
+        "next_target": lambda command: switch_target(command, 1),
+        "prev_target": lambda command: switch_target(command, -1),
+        "auto_target": auto_target,
+    }, action_map)
 
     try:
         while True:
@@ -85,75 +212,45 @@ def main():
             if not is_locked:
                 try:
                     hwnd = win32gui.GetForegroundWindow()
+                    scheduler.foreground(hwnd)
                     _, pid = win32process.GetWindowThreadProcessId(hwnd)
-                    proc = psutil.Process(pid)
-                    proc_name = proc.name()
-                    debug_info = {'name': proc_name, 'pid': pid}
-                    
-                    found_match = False
-                    for i, session in enumerate(sessions):
-                        if session.Process and session.Process.name() == proc_name:
-                            current_index = i
-                            found_match = True
-                            break
-                    if not found_match:
-                        current_index = None
+                    index, proc_name = foreground.update(hwnd, pid)
+                    debug_info = {'name': proc_name, 'pid': foreground.current[1]}
+                    if index != current_index:
+                        current_index = index
+                        if index is not None: send_volume_to_mcu(sync, sessions[index])
                 except (psutil.NoSuchProcess, psutil.AccessDenied, win32process.error):
                     current_index = None
                     debug_info = {'name': '錯誤或無權限', 'pid': 'N/A'}
             
             print_status(sessions, current_index, SERIAL_PORT, is_locked, debug_info)
             
-            # 2. 讀取指令
-            line = ser.readline()
+            # 2. 讀取指令 (逾時長短依閒置狀態調整)
+            line = scheduler.read_line(ser)
+            sync.hello_if_idle(target_session(0) is not None)
             if not line:
-                sessions = get_all_sessions()
+                new_sessions = get_all_sessions()
+                # 清單內容改變時索引會失效，清除前景快取
+                # (比對快取的 psutil pid，不對每個 session 呼叫 COM 的 ProcessId)
+                if [s.Process.pid for s in new_sessions] != [s.Process.pid for s in sessions]: foreground.invalidate()
+                sessions = new_sessions
                 continue
             
-            command = line.decode('utf-8').strip()
+            line = line.decode('utf-8').strip()
+            if sync.handle_line(line): continue
+            command = parse_frame(line)
 
-            # 3. 指令解析
-            if command == "UNLOCK":
-                is_locked = False
+            # 3. 查表執行對應的動作
+            try:
+                dispatcher.dispatch(command)
+            except IndexError:
                 current_index = None
-                continue
-
-            if command in ["NEXT_APP", "PREV_APP"]:
-                is_locked = True
-                if not sessions: continue
-                if current_index is None: current_index = -1 if command == "NEXT_APP" else 0
-                
-                if command == "NEXT_APP": current_index = (current_index + 1) % len(sessions)
-                else: current_index = (current_index - 1 + len(sessions)) % len(sessions)
-
-            # 4. 執行動作
-            if current_index is not None and sessions and current_index < len(sessions):
-                try:
-                    target_session = sessions[current_index]
-                    vol = target_session.SimpleAudioVolume
-
-                    if command == "UP" or command == "DOWN":
-                        current_time = time.monotonic()
-                        time_diff = current_time - last_turn_time
-                        last_turn_time = current_time
-                        
-                        clamped_diff = max(MIN_TIMEDIFF, min(time_diff, MAX_TIMEDIFF))
-                        speed_ratio = (MAX_TIMEDIFF - clamped_diff) / (MAX_TIMEDIFF - MIN_TIMEDIFF)
-                        step = MIN_VOLUME_STEP + (MAX_VOLUME_STEP - MIN_VOLUME_STEP) * speed_ratio
-                        
-                        if command == "UP": vol.SetMasterVolume(min(1.0, vol.GetMasterVolume() + step), None)
-                        else: vol.SetMasterVolume(max(0.0, vol.GetMasterVolume() - step), None)
-
-                    elif command == "MUTE":
-                        vol.SetMute(not vol.GetMute(), None)
-                    
-                    send_volume_to_mcu(ser, target_session)
-                except IndexError:
-                    current_index = None
 
     except Exception as e:
         print(f"\n程式發生未預期錯誤: {e}")
     finally:
+        volume_writer.stop()
+        if writer: writer.stop()
         if ser and ser.is_open: ser.close()
         print("程式已結束。")
 
@@ -1,10 +1,20 @@
 # volume_controller.py - 動態加速度版
 # 功能：根據旋轉速度，平滑地調整音量變化的幅度
+#       (多旋鈕韌體下只處理通道 0 的指令；音量由背景寫入器限速套用)
+#       閒置時把重新列舉 session 的間隔從 1 秒放慢到 10 秒
+#       LED 音量由背景寫入執行緒送出，裝置忙碌時不會卡住讀取
+#       指令由共用的 Dispatcher 查表分派 (actions.json)
+#       連線後以 HELLO 握手 (帶目標的實際音量) 同步 LED，並依韌體支援的功能選擇 LED 指令格式
 
 import os
 import time
 import serial
 from pycaw.pycaw import AudioUtilities
+from device_protocol import parse_frame, volume_step, StateSync
+from volume_writer import VolumeWriter, session_key
+from activity_scheduler import ActivityScheduler
+from serial_writer import SerialWriter
+from command_dispatch import Dispatcher, load_action_map
 
 # --- 設定 ---
 SERIAL_PORT = 'COM8'
@@ -28,7 +38,7 @@ def get_active_sessions():
     sessions = AudioUtilities.GetAllSessions()
     return [s for s in sessions if s.Process]
 
-def print_status(sessions, current_index, port_name):
+def print_status(sessions, current_index, port_name, volume_writer):
     os.system('cls' if os.name == 'nt' else 'clear')
     print("--- RP2040 音量控制器 (動態加速度版) ---")
     print(f"狀態: 正在與 {port_name} 雙向通訊...")
@@ -40,8 +50,10 @@ def print_status(sessions, current_index, port_name):
     for i, session in enumerate(sessions):
         try:
             prefix = ">> " if i == current_index else "   "
-            volume_percent = f"{session.SimpleAudioVolume.GetMasterVolume():.0%}"
-            mute_status = " [靜音]" if session.SimpleAudioVolume.GetMute() else ""
+            # 只顯示寫入器快取的狀態，主迴圈不呼叫 COM (還沒讀到的顯示為 ?)
+            volume, muted = volume_writer.peek(session)
+            volume_percent = "?" if volume is None else f"{volume:.0%}"
+            mute_status = " [靜音]" if muted else ""
             print(f"{prefix}[{i}] - {session.Process.name()} @ {volume_percent}{mute_status}")
         except Exception: continue
     print("\n---------------------------------")
@@ -53,31 +65,75 @@ def print_status(sessions, current_index, port_name):
 
 
 def main():
+    # 連線前先載入並檢查動作設定
+    try: action_map = load_action_map()
+    except ValueError as e:
+        print(f"錯誤：{e}")
+        return
+
     try:
         ser = serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=1)
-        print(f"成功連接到 {SERIAL_PORT}！")
-        time.sleep(2)
     except serial.SerialException as e:
         print(f"錯誤：無法開啟序列埠 {SERIAL_PORT}。詳細錯誤: {e}")
         return
 
+    # 連線握手: 背景讀到目標的實際音量後立即以 HELLO 送出 (CircuitPython 的 USB CDC 開啟時不會重新開機，不必等待)；
+    # 沒有目標或讀取逾時就先以空狀態握手。此版本不管理麥克風，麥克風欄位送 "-"
+    writer = SerialWriter(ser)
+    sync = StateSync(writer)
+    print(f"成功連接到 {SERIAL_PORT}！")
+    # 背景讀到目前目標的實際音量 (或被外部改動) 時更新 LED；session 物件可能已重建，以識別碼比對
+    volume_writer = VolumeWriter(on_refresh=lambda session: sessions and session_key(session) == session_key(sessions[current_index]) and send_volume_to_mcu(session))
+
     def send_volume_to_mcu(session):
         if not session: return
         try:
-            is_muted = session.SimpleAudioVolume.GetMute()
-            level = 0 if is_muted else int(session.SimpleAudioVolume.GetMasterVolume() * 100)
-            ser.write(f"V:{level}\n".encode('utf-8'))
+            sync.push(*volume_writer.state(session))  # 寫入執行緒還沒讀到實際音量時不送
         except Exception: pass
 
     sessions = get_active_sessions()
     current_index = 0
+    scheduler = ActivityScheduler(active_interval=1.0, idle_interval=10.0)
     last_turn_time = 0
 
-    if sessions: send_volume_to_mcu(sessions[current_index])
+    # --- 動作處理函式 (由 Dispatcher 依 actions.json 查表呼叫) ---
+    def change_volume(command, direction):
+        nonlocal last_turn_time
+        target_session = sessions[current_index]
+        current_time = time.monotonic()
+        time_diff = current_time - last_turn_time
+        last_turn_time = current_time
+
+        # --- 全新的動態步進計算 ---
+        # 依每格平均時間間隔計算速度比例，再線性算出音量步進
+        # (韌體一次合併多格旋轉時，步進乘上格數)
+        step = volume_step(time_diff, command.count, MIN_TIMEDIFF, MAX_TIMEDIFF, MIN_VOLUME_STEP, MAX_VOLUME_STEP)
+
+        # 只更新目標值 (相對調整)，實際讀寫由 volume_writer 在背景執行
+        volume_writer.shift_volume([target_session], step * direction)
+
+    def toggle_mute(command):
+        target_session = sessions[current_index]
+        volume_writer.toggle_group_mute([target_session])
+
+    def switch_target(command, direction):
+        nonlocal current_index
+        current_index = (current_index + command.count * direction) % len(sessions)
+
+    dispatcher = Dispatcher({
+        "volume_up": lambda command: change_volume(command, 1),
+        "volume_down": lambda command: change_volume(command, -1),
+        "mute": toggle_mute,
+        "next_target": lambda command: switch_target(command, 1),
+        "prev_target": lambda command: switch_target(command, -1),
+    }, action_map)
+
+    if sessions: send_volume_to_mcu(sessions[current_index])  # 觸發背景讀取目前目標的音量
     
     try:
         while True:
-            line = ser.readline()
+            line = scheduler.read_line(ser)
+            sync.hello_if_idle(bool(sessions))
             if not line:
                 new_sessions = get_active_sessions()
                 if len(new_sessions) != len(sessions) or not all(s in new_sessions for s in sessions):
@@ -86,48 +142,23 @@ def main():
                     if sessions: send_volume_to_mcu(sessions[current_index])
                 continue
             
-            command = line.decode('utf-8').strip()
-            if not sessions: continue
+            line = line.decode('utf-8').strip()
+            if sync.handle_line(line): continue
+            command = parse_frame(line)
+            if not sessions or command.channel != 0: continue
             
-            target_session = sessions[current_index]
-            vol = target_session.SimpleAudioVolume
-
-            if command == "UP" or command == "DOWN":
-                current_time = time.monotonic()
-                time_diff = current_time - last_turn_time
-                last_turn_time = current_time
-
-                # --- 全新的動態步進計算 ---
-                # 1. 將時間差限制在我們定義的範圍內
-                clamped_diff = max(MIN_TIMEDIFF, min(time_diff, MAX_TIMEDIFF))
-                
-                # 2. 計算速度比例 (0.0 代表最慢, 1.0 代表最快)
-                #    公式是 (最大時間 - 當前時間) / (最大時間 - 最小時間)
-                speed_ratio = (MAX_TIMEDIFF - clamped_diff) / (MAX_TIMEDIFF - MIN_TIMEDIFF)
-                
-                # 3. 根據速度比例，線性計算出最終的音量步進
-                step = MIN_VOLUME_STEP + (MAX_VOLUME_STEP - MIN_VOLUME_STEP) * speed_ratio
-                
-                if command == "UP":
-                    vol.SetMasterVolume(min(1.0, vol.GetMasterVolume() + step), None)
-                else: # DOWN
-                    vol.SetMasterVolume(max(0.0, vol.GetMasterVolume() - step), None)
-
-            elif command == "MUTE":
-                vol.SetMute(not vol.GetMute(), None)
-            elif command == "NEXT_APP":
-                current_index = (current_index + 1) % len(sessions)
-            elif command == "PREV_APP":
-                current_index = (current_index - 1 + len(sessions)) % len(sessions)
+            dispatcher.dispatch(command)
             
             send_volume_to_mcu(sessions[current_index])
-            print_status(sessions, current_index, SERIAL_PORT)
+            print_status(sessions, current_index, SERIAL_PORT, volume_writer)
 
     except serial.SerialException:
         print(f"\n錯誤：與 {SERIAL_PORT} 的連線中斷。")
     except KeyboardInterrupt:
         print("\n程式已由使用者手動結束。")
     finally:
+        volume_writer.stop()
+        writer.stop()
         if 'ser' in locals() and ser.is_open:
             ser.close()
 
@@ -0,0 +1,185 @@
+# volume_writer.py - 背景音量寫入器 (write-behind)
+# 功能: 1. 旋鈕事件只更新每個 session 的「目標音量」，真正的 SetMasterVolume 由
+#          該 session 專屬的寫入執行緒以限定頻率執行，永遠只寫最新值，中間值直接丟棄。
+#       2. 每個 session 各自一條執行緒，某個程式的 COM 呼叫卡住時，
+#          不會拖累序列埠讀取、前景偵測或其他 session。
+#       3. 音量/靜音狀態會快取並由寫入執行緒定期更新，呼叫端 (主迴圈) 永遠不呼叫 COM:
+#          第一次接觸某個 session 時狀態為未知 (None)，由寫入執行緒讀取；
+#          在此之前的相對調整 (shift_volume / toggle_group_mute) 會先累積，讀到實際值後再套用。
+#       4. 群組操作 (shift_volume / set_group_mute) 在一次鎖定內更新所有成員的目標，
+#          再同時喚醒各自的寫入執行緒。
+#       5. on_refresh(session): 寫入執行緒讀到的實際狀態與快取不同時 (包含第一次讀取) 呼叫，
+#          可用來更新 LED；會在寫入執行緒上執行。
+#       6. 查詢與設定都會延長 session 的存活時間，只有一段時間完全沒人使用才結束執行緒。
+#       7. 一段時間 (IDLE_AFTER) 沒有設定過的 session 改以 IDLE_REFRESH_INTERVAL 低頻同步外部變更，
+#          只被輪詢顯示的目標不會整夜每秒呼叫 COM；下一次設定立即回到每秒同步。
+
+import threading
+import time
+import comtypes
+from trace_recorder import tracer
+from activity_scheduler import IDLE_AFTER
+
+WRITE_INTERVAL = 1 / 30   # 每個 session 最快每秒寫入 30 次
+REFRESH_INTERVAL = 1.0    # 沒有寫入時多久重新讀取一次實際音量 (外部被改動時同步)
+IDLE_REFRESH_INTERVAL = 10.0  # 超過 IDLE_AFTER 秒沒有設定時，改為多久讀取一次
+IDLE_EXIT = 30.0          # 多久沒有查詢或設定就結束該 session 的寫入執行緒
+
+def session_key(session):
+    """以 session 實例識別碼作為 key，session 清單重建後仍對應同一個寫入器。
+    識別碼記在 session 物件上，同一個物件只查詢一次 (可在列舉 session 時預先呼叫)"""
+    key = getattr(session, "_volume_writer_key", None)
+    if key is None:
+        try: key = session.InstanceIdentifier
+        except Exception: key = id(session)
+        try: session._volume_writer_key = key
+        except AttributeError: pass
+    return key
+
+class _Slot:
+    def __init__(self, session):
+        self.session = session
+        self.volume, self.muted = None, None       # None: 寫入執行緒尚未讀到實際值
+        self.volume_delta, self.mute_toggle = 0.0, False  # 未知狀態時累積的相對調整
+        self.volume_pending, self.mute_pending = False, False
+        self.last_used = self.last_set = time.monotonic()
+        self.wake = threading.Event()
+
+class VolumeWriter:
+    def __init__(self, write_interval=WRITE_INTERVAL, on_refresh=None):
+        self.write_interval = write_interval
+        self.on_refresh = on_refresh
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._stop_event = threading.Event()
+
+    def _slot_locked(self, session, key, setting=False):
+        """取得 (必要時建立) session 的 slot 並延長存活時間 (setting 為 True 時同時記錄設定時間)；
+        呼叫端須持有 self._lock。查詢與設定在同一次鎖定內完成，寫入執行緒不會在兩者之間移除 slot"""
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = _Slot(session)
+            threading.Thread(target=self._run, args=(key, slot), name=f"VolumeWriter-{key}", daemon=True).start()
+        slot.session, slot.last_used = session, time.monotonic()
+        if setting: slot.last_set = slot.last_used
+        return slot
+
+    def state(self, session):
+        """回傳 (目標音量, 是否靜音)，尚未寫入的最新值優先；還沒讀到實際值時為 (None, None)"""
+        key = session_key(session)
+        with self._lock:
+            slot = self._slot_locked(session, key)
+            return slot.volume, slot.muted
+
+    def peek(self, session):
+        """只讀取快取的 (音量, 靜音)，不建立 slot 也不延長存活時間；沒有追蹤中的狀態時為 (None, None)"""
+        key = session_key(session)
+        with self._lock:
+            slot = self._slots.get(key)
+            return (slot.volume, slot.muted) if slot else (None, None)
+
+    def level(self, session):
+        """回傳要顯示在 LED 上的音量百分比 (靜音時為 0)，狀態未知時為 None"""
+        volume, muted = self.state(session)
+        if volume is None: return None
+        return 0 if muted else int(volume * 100)
+
+    def set_volume(self, session, volume):
+        key = session_key(session)
+        with self._lock:
+            slot = self._slot_locked(session, key, setting=True)
+            slot.volume, slot.volume_delta, slot.volume_pending = volume, 0.0, True
+        slot.wake.set()
+
+    def set_mute(self, session, muted):
+        self.set_group_mute([session], muted)
+
+    def shift_volume(self, sessions, delta):
+        """將一組 session 的目標音量同時加減 delta，回傳第一個 (主要) session 的新音量 (未知時為 None)"""
+        keys = [session_key(s) for s in sessions]
+        with self._lock:
+            slots = [self._slot_locked(s, key, setting=True) for s, key in zip(sessions, keys)]
+            for slot in slots:
+                if slot.volume is None: slot.volume_delta += delta
+                else: slot.volume = max(0.0, min(1.0, slot.volume + delta))
+                slot.volume_pending = True
+            leader_volume = slots[0].volume if slots else None
+        for slot in slots: slot.wake.set()
+        return leader_volume
+
+    def set_group_mute(self, sessions, muted):
+        keys = [session_key(s) for s in sessions]
+        with self._lock:
+            slots = [self._slot_locked(s, key, setting=True) for s, key in zip(sessions, keys)]
+            for slot in slots:
+                slot.muted, slot.mute_toggle, slot.mute_pending = muted, False, True
+        for slot in slots: slot.wake.set()
+
+    def toggle_group_mute(self, sessions):
+        """依第一個 session 的狀態切換整組的靜音；狀態未知時由寫入執行緒讀到實際值後再反轉"""
+        keys = [session_key(s) for s in sessions]
+        with self._lock:
+            slots = [self._slot_locked(s, key, setting=True) for s, key in zip(sessions, keys)]
+            if not slots: return None
+            leader_muted = slots[0].muted
+            for slot in slots:
+                if leader_muted is not None: slot.muted, slot.mute_toggle = not leader_muted, False
+                elif slot.muted is not None: slot.muted = not slot.muted
+                else: slot.mute_toggle = not slot.mute_toggle
+                slot.mute_pending = True
+            result = None if leader_muted is None else not leader_muted
+        for slot in slots: slot.wake.set()
+        return result
+
+    def stop(self):
+        self._stop_event.set()
+        with self._lock: slots = list(self._slots.values())
+        for slot in slots: slot.wake.set()
+
+    def _refresh_interval(self, slot):
+        with self._lock: idle = time.monotonic() - slot.last_set > IDLE_AFTER
+        return IDLE_REFRESH_INTERVAL if idle else REFRESH_INTERVAL
+
+    def _run(self, key, slot):
+        # 音訊 session 介面是 free-threaded，可以直接在 MTA 執行緒中使用
+        comtypes.CoInitializeEx(comtypes.COINIT_MULTITHREADED)
+        try:
+            refresh = True  # 第一次進來先讀取實際音量/靜音
+            while not self._stop_event.is_set():
+                with self._lock: session, unknown = slot.session, slot.volume is None or slot.muted is None
+                try:
+                    vol = session.SimpleAudioVolume
+                    if refresh or unknown:
+                        # 同步外部的變更，但不覆蓋剛送進來的新目標；未知時累積的相對調整在此套用
+                        with tracer.span("com.refresh"): current_volume, current_muted = vol.GetMasterVolume(), bool(vol.GetMute())
+                        with self._lock:
+                            before = (slot.volume, slot.muted)
+                            if slot.volume is None:
+                                slot.volume, slot.volume_delta = max(0.0, min(1.0, current_volume + slot.volume_delta)), 0.0
+                            elif not slot.volume_pending: slot.volume = current_volume
+                            if slot.muted is None:
+                                slot.muted, slot.mute_toggle = current_muted != slot.mute_toggle, False
+                            elif not slot.mute_pending: slot.muted = current_muted
+                            changed = before != (slot.volume, slot.muted)
+                        if changed and self.on_refresh:
+                            try: self.on_refresh(session)
+                            except Exception: pass
+                    with self._lock:
+                        volume, muted = slot.volume, slot.muted
+                        write_volume, write_mute = slot.volume_pending, slot.mute_pending
+                        slot.volume_pending = slot.mute_pending = False
+                    if write_volume:
+                        with tracer.span("com.set_volume", volume=volume): vol.SetMasterVolume(volume, None)
+                    if write_mute:
+                        with tracer.span("com.set_mute", muted=muted): vol.SetMute(muted, None)
+                    if write_volume or write_mute: time.sleep(self.write_interval)  # 限制寫入頻率
+                except Exception: pass  # session 暫時失效: 下次心跳再試，沒人使用時自然結束
+                with self._lock:
+                    # 查詢/設定會在同一把鎖內延長 last_used，因此被移除的 slot 不可能還有人剛設定過
+                    if time.monotonic() - slot.last_used > IDLE_EXIT:
+                        if self._slots.get(key) is slot: del self._slots[key]
+                        break
+                refresh = not slot.wake.wait(self._refresh_interval(slot))
+                slot.wake.clear()
+        finally:
+            comtypes.CoUninitialize()
@@ -1,6 +1,16 @@
-# code.py - 亮度控制版
+# code.py - 多旋鈕版
 # 功能: 1. 新增雙擊進入/退出「亮度調節模式」。
 #       2. 在亮度模式下，旋轉可調節LED亮度。
+#       3. 支援多組旋鈕，同一個迴圈掃描所有通道，按鈕共用一個 keypad 事件佇列。
+#       4. 送出的事件帶通道編號，並在每輪迴圈合併為一次寫出:
+#          "<通道>:<指令>[:<次數>]\n"，例如 "0:UP:2"、"1:MUTE"。
+#       5. 所有計時改用整數毫秒 supervisor.ticks_ms()，長時間開機也不會失準；
+#          按下/放開的時間取自 keypad 事件本身的 timestamp，迴圈忙碌時手勢判斷也不會延遲。
+#       6. 電腦送來 "TRACE:1" 後，額外回報 "T:<開始ms>:<長度ms>:<名稱>" 供時間軸追蹤。
+#       7. 連線握手: 收到 "HELLO:<協定>:<音量>:<靜音>:<麥克風靜音>" 立即更新 LED，並回覆
+#          "HELLO:<韌體版本>:<協定>:<功能,...>:<亮度%>:<模式>"。
+#          "S:<音量>:<靜音>:<麥克風靜音>" 更新完整狀態: 靜音時音量條變暗，麥克風靜音時第一顆燈為紫色。
+#       8. 離開亮度模式時把亮度存入 microcontroller.nvm，重新開機後沿用。
 
 import time
 import board
@@ -8,85 +18,188 @@ import rotaryio
 import keypad
 import usb_cdc
 import neopixel
+import supervisor
+import microcontroller
 
 # --- 設定 ---
 NEOPIXEL_PIN = board.GP0
 NUM_PIXELS = 15
-LONG_PRESS_S = 0.5
-UNLOCK_PRESS_S = 3.0
-DOUBLE_CLICK_S = 0.4 # 雙擊的有效時間間隔 (秒)
+# 每個通道一組 (編碼器A腳, 編碼器B腳, 按鈕腳)，依序為通道 0, 1, 2...
+CHANNEL_PINS = (
+    (board.GP2, board.GP3, board.GP4),
+    # (board.GP5, board.GP6, board.GP7),
+    # (board.GP8, board.GP9, board.GP10),
+    # (board.GP11, board.GP12, board.GP13),
+)
+LONG_PRESS_MS = 500
+UNLOCK_PRESS_MS = 3000
+DOUBLE_CLICK_MS = 400 # 雙擊的有效時間間隔 (毫秒)
+RUN_TICKS_SELF_TEST = False # 開機時模擬數週開機時間，驗證 ticks_diff 跨回捲點的計算
+FW_VERSION = "2.0"
+PROTOCOL_VERSION = 2
+CAPABILITIES = "CH,BATCH,TRACE,STATE" # 握手時告訴電腦本韌體支援的功能
+BRIGHTNESS_NVM_MARK = 0xB5 # nvm[0] 為此值時，nvm[1] 是儲存的亮度百分比
+
+# --- 整數毫秒計時 ---
+# time.monotonic() 是浮點數，開機數天後會失去毫秒解析度；ticks_ms() 是整數，
+# 每 2**29 毫秒 (約 6.2 天) 回捲一次，因此一律用 ticks_diff 計算時間差。
+_TICKS_PERIOD = 1 << 29
+_TICKS_MAX = _TICKS_PERIOD - 1
+_TICKS_HALFPERIOD = _TICKS_PERIOD // 2
+
+def ticks_diff(t1, t2):
+    """回傳 t1 - t2 (毫秒)，跨越回捲點也正確 (時間差需小於約 3.1 天)"""
+    diff = (t1 - t2) & _TICKS_MAX
+    return ((diff + _TICKS_HALFPERIOD) & _TICKS_MAX) - _TICKS_HALFPERIOD
+
+def ticks_self_test(days=28):
+    """只測試 ticks_diff 本身: 模擬 days 天的 ticks_ms 值 (含每一次回捲點)，
+    檢查各手勢門檻長度的時間差是否算對、門檻前後 1 毫秒是否分得出來；不會執行按鈕處理邏輯。
+    同時以浮點秒數計算同樣的時間差作為對照，回傳 (整數最大誤差, 浮點最大誤差)。"""
+    day_ms = 24 * 60 * 60 * 1000
+    starts = list(range(0, days * day_ms, 6 * 60 * 60 * 1000))
+    for wrap in range(1, days * day_ms // _TICKS_PERIOD + 1):
+        starts += [wrap * _TICKS_PERIOD - d for d in (1, DOUBLE_CLICK_MS // 2, LONG_PRESS_MS // 2, UNLOCK_PRESS_MS // 2)]
+    max_err, max_float_err = 0, 0
+    for raw in starts:
+        for threshold in (DOUBLE_CLICK_MS, LONG_PRESS_MS, UNLOCK_PRESS_MS):
+            for offset in (-1, 0, 1):
+                expected = threshold + offset
+                measured = ticks_diff((raw + expected) & _TICKS_MAX, raw & _TICKS_MAX)
+                # 門檻判斷必須與真實時間一致 (差 1 毫秒也要分得出來)
+                if (measured >= threshold) != (offset >= 0): max_err = max(max_err, threshold)
+                max_err = max(max_err, abs(measured - expected))
+                float_measured = ((raw + expected) / 1000 - raw / 1000) * 1000
+                max_float_err = max(max_float_err, abs(float_measured - expected))
+    return max_err, max_float_err
+
+# --- 亮度儲存 (nvm 位於 flash，只在亮度改變後離開亮度模式時寫入) ---
+def load_brightness(default):
+    try:
+        if microcontroller.nvm[0] == BRIGHTNESS_NVM_MARK: return max(1, min(100, microcontroller.nvm[1])) / 100
+    except (TypeError, IndexError): pass # 此板子沒有 nvm
+    return default
+
+def save_brightness(value):
+    percent = round(value * 100)
+    try:
+        if microcontroller.nvm[0] != BRIGHTNESS_NVM_MARK or microcontroller.nvm[1] != percent:
+            microcontroller.nvm[0:2] = bytes((BRIGHTNESS_NVM_MARK, percent))
+    except (TypeError, IndexError): pass
 
 # --- 初始化 ---
-encoder = rotaryio.IncrementalEncoder(board.GP2, board.GP3)
-keys = keypad.Keys(pins=(board.GP4,), value_when_pressed=False, pull=True)
+encoders = [rotaryio.IncrementalEncoder(a, b) for a, b, _ in CHANNEL_PINS]
+# 所有按鈕共用一個 keypad 佇列，event.key_number 即為通道編號
+keys = keypad.Keys(pins=tuple(btn for _, _, btn in CHANNEL_PINS), value_when_pressed=False, pull=True)
+key_event = keypad.Event()
+NUM_CHANNELS = len(encoders)
 serial = usb_cdc.console
-pixels = neopixel.NeoPixel(NEOPIXEL_PIN, NUM_PIXELS, brightness=0.3, auto_write=False)
+current_brightness = load_brightness(0.3)
+pixels = neopixel.NeoPixel(NEOPIXEL_PIN, NUM_PIXELS, brightness=current_brightness, auto_write=False)
 
-# --- 狀態變數 ---
-last_position = encoder.position
-button_down_time = None
-is_in_switch_mode = False
-unlock_triggered = False
-rotation_during_press = False
+# --- 狀態變數 (每個通道一份) ---
+last_positions = [e.position for e in encoders]
+button_down_times = [None] * NUM_CHANNELS
+switch_modes = [False] * NUM_CHANNELS
+unlock_triggered = [False] * NUM_CHANNELS
+rotation_during_press = [False] * NUM_CHANNELS
+last_click_times = [None] * NUM_CHANNELS # 用於判斷雙擊 (ticks_ms)，同一顆旋鈕連按兩下才算
 
 # 新增：控制模式與亮度相關變數
 control_mode = "VOLUME"  # "VOLUME" 或 "BRIGHTNESS"
-current_brightness = 0.3 # 初始亮度
-last_click_time = 0      # 用於判斷雙擊
+trace_enabled = False    # 由電腦端以 "TRACE:1" 開啟
 
-# (update_volume_leds 函式不變)
-def update_volume_leds(level):
+def update_volume_leds(level, muted=False, mic_muted=False):
     leds_to_light = round(level / 100 * NUM_PIXELS)
     for i in range(NUM_PIXELS):
         if i < leds_to_light:
-            if i < NUM_PIXELS * 0.5: pixels[i] = (0, 255, 0)
+            if muted: pixels[i] = (40, 40, 40)
+            elif i < NUM_PIXELS * 0.5: pixels[i] = (0, 255, 0)
             elif i < NUM_PIXELS * 0.8: pixels[i] = (255, 255, 0)
             else: pixels[i] = (255, 0, 0)
         else: pixels[i] = (0, 0, 0)
+    if mic_muted: pixels[0] = (255, 0, 255)
     pixels.show()
 
-print("--- RP2040 韌體已啟動 (亮度控制版) ---")
+def apply_state(fields):
+    """套用 "<音量>:<靜音>:<麥克風靜音>" 三個欄位"""
+    update_volume_leds(int(fields[0]), fields[1] == "1", fields[2] == "1")
+
+def check_press(ch, at, outgoing):
+    """以時間點 at (ticks_ms) 判斷按住中的按鈕是否已達長按 / 解鎖門檻"""
+    press_duration = ticks_diff(at, button_down_times[ch])
+    if not switch_modes[ch] and press_duration >= LONG_PRESS_MS:
+        switch_modes[ch] = True
+    if switch_modes[ch] and not unlock_triggered[ch] and press_duration >= UNLOCK_PRESS_MS:
+        outgoing.append(f"{ch}:UNLOCK")
+        unlock_triggered[ch] = True
+        # ... 解鎖提示燈光 ...
+        for _ in range(3):
+            pixels.fill((255, 255, 255)); pixels.show(); time.sleep(0.05)
+            pixels.fill((0, 0, 0)); pixels.show(); time.sleep(0.05)
+
+print(f"--- RP2040 韌體已啟動 (多旋鈕版, {NUM_CHANNELS} 通道) ---")
+if RUN_TICKS_SELF_TEST:
+    ticks_err, float_err = ticks_self_test()
+    passed = ticks_err <= 1
+    print(f"ticks_diff 自我測試: 最大誤差 {ticks_err} ms, 浮點對照 {float_err:.1f} ms -> {'PASS' if passed else 'FAIL'}")
+    # 結果燈號：綠色通過、紅色失敗
+    pixels.fill((0, 255, 0) if passed else (255, 0, 0)); pixels.show(); time.sleep(1)
 update_volume_leds(0)
 incoming_buffer = ""
 
-# --- 主迴圈 (邏輯重大更新) ---
+# --- 主迴圈 (逐一掃描所有通道，事件批次送出) ---
 while True:
-    # (接收電腦指令的邏輯不變)
+    outgoing = []  # 本輪要送出的事件，迴圈最後一次寫出
+    now = supervisor.ticks_ms()  # 本輪的輪詢計時以此為準 (按鈕事件用各自的 timestamp)
+
+    # 接收電腦指令
     if serial.in_waiting > 0:
         incoming_buffer += serial.read(serial.in_waiting).decode()
-        if "\n" in incoming_buffer:
+        # 一次處理所有完整的行 (連線時握手與其他指令可能同時到達)
+        while "\n" in incoming_buffer:
             line, incoming_buffer = incoming_buffer.split("\n", 1)
-            if line.startswith("V:"):
-                try: update_volume_leds(int(line[2:]))
-                except (ValueError, IndexError): pass
-
-    # --- 旋轉邏輯更新：根據模式決定行為 ---
-    current_position = encoder.position
-    if current_position != last_position:
-        # 如果在亮度模式
+            line = line.strip()
+            try:
+                if line.startswith("V:") or line.startswith("S:"):
+                    led_start = supervisor.ticks_ms()  # 區段只包含 LED 更新本身，不含讀取序列埠的時間
+                    if line[0] == "V": update_volume_leds(int(line[2:]))
+                    else: apply_state(line[2:].split(":"))
+                    if trace_enabled:
+                        outgoing.append(f"T:{led_start}:{ticks_diff(supervisor.ticks_ms(), led_start)}:LED")
+                elif line.startswith("HELLO:"):
+                    apply_state(line.split(":")[2:5])
+                    outgoing.append(f"HELLO:{FW_VERSION}:{PROTOCOL_VERSION}:{CAPABILITIES}:{round(current_brightness * 100)}:{control_mode}")
+                elif line.startswith("TRACE:"):
+                    trace_enabled = line[6:] == "1"
+            except (ValueError, IndexError): pass
+
+    # --- 旋轉邏輯：每個通道只讀一次位置，多格旋轉合併成一個事件 ---
+    for ch in range(NUM_CHANNELS):
+        current_position = encoders[ch].position
+        delta = current_position - last_positions[ch]
+        if not delta: continue
+        last_positions[ch] = current_position
+        # 如果在亮度模式 (任一旋鈕皆可調整)
         if control_mode == "BRIGHTNESS":
-            if current_position > last_position: # 順時針增加亮度
-                current_brightness = min(1.0, current_brightness + 0.01)
-            else: # 逆時針減少亮度
-                current_brightness = max(0.01, current_brightness - 0.01)
+            current_brightness = max(0.01, min(1.0, current_brightness + 0.01 * delta))
             pixels.brightness = current_brightness
             pixels.show() # 立刻應用亮度
         # 如果在音量模式 (且長按切換App中)
-        elif is_in_switch_mode:
-            rotation_during_press = True
-            serial.write(b"NEXT_APP\n" if current_position > last_position else b"PREV_APP\n")
+        elif switch_modes[ch]:
+            rotation_during_press[ch] = True
+            outgoing.append(f"{ch}:{'NEXT_APP' if delta > 0 else 'PREV_APP'}:{abs(delta)}")
         # 預設的音量模式
         else:
-            serial.write(b"UP\n" if current_position > last_position else b"DOWN\n")
-        last_position = current_position
+            outgoing.append(f"{ch}:{'UP' if delta > 0 else 'DOWN'}:{abs(delta)}")
 
-    # --- 按鈕事件邏輯更新：加入雙擊判斷 ---
-    event = keys.events.get()
-    if event:
-        if event.pressed:
+    # --- 按鈕事件邏輯：一次取完佇列中所有事件 (get_into 不配置新物件) ---
+    while keys.events.get_into(key_event):
+        ch = key_event.key_number
+        event_time = key_event.timestamp  # 按鈕實際變化的時間，不受迴圈延遲影響
+        if key_event.pressed:
             # 判斷雙擊
-            time_since_last_click = time.monotonic() - last_click_time
-            if time_since_last_click < DOUBLE_CLICK_S:
+            if last_click_times[ch] is not None and ticks_diff(event_time, last_click_times[ch]) < DOUBLE_CLICK_MS:
                 # --- 觸發雙擊 ---
                 if control_mode == "VOLUME":
                     control_mode = "BRIGHTNESS"
@@ -95,43 +208,47 @@ while True:
                     pixels.show() # 恢復原樣
                 else:
                     control_mode = "VOLUME"
+                    save_brightness(current_brightness)
                     # 提示回到音量模式：閃爍藍色
                     pixels.fill((0, 0, 255)); pixels.show(); time.sleep(0.1)
                     pixels.show() # 恢復原樣
                 
-                last_click_time = 0 # 重置雙擊計時，防止三擊
-                button_down_time = None # 雙擊後不觸發長按或短按
+                last_click_times[ch] = None # 重置雙擊計時，防止三擊
+                button_down_times[ch] = None # 雙擊後不觸發長按或短按
             else:
                 # --- 記錄單擊 ---
-                button_down_time = time.monotonic()
-                is_in_switch_mode = False
-                unlock_triggered = False
-                rotation_during_press = False
-                last_click_time = time.monotonic()
-
-        elif event.released:
-            # 只有在非雙擊的情況下，才處理長短按
-            if button_down_time is not None:
-                if is_in_switch_mode:
-                    if not rotation_during_press and not unlock_triggered:
-                        serial.write(b"MIC_MUTE\n")
-                elif not unlock_triggered:
-                     serial.write(b"MUTE\n")
+                button_down_times[ch] = event_time
+                switch_modes[ch] = False
+                unlock_triggered[ch] = False
+                rotation_during_press[ch] = False
+                last_click_times[ch] = event_time
+
+        elif key_event.released:
+            # 只有在非雙擊的情況下，才處理長短按 (按住多久以放開的時間計算)
+            if button_down_times[ch] is not None:
+                check_press(ch, event_time, outgoing)
+                if switch_modes[ch]:
+                    if not rotation_during_press[ch] and not unlock_triggered[ch]:
+                        outgoing.append(f"{ch}:MIC_MUTE")
+                elif not unlock_triggered[ch]:
+                     outgoing.append(f"{ch}:MUTE")
             
-            button_down_time = None
-            is_in_switch_mode = False
-
-    # (模式判斷邏輯不變)
-    if button_down_time is not None:
-        press_duration = time.monotonic() - button_down_time
-        if not is_in_switch_mode and press_duration >= LONG_PRESS_S:
-            is_in_switch_mode = True
-        if is_in_switch_mode and not unlock_triggered and press_duration >= UNLOCK_PRESS_S:
-            serial.write(b"UNLOCK\n")
-            unlock_triggered = True
-            # ... 解鎖提示燈光 ...
-            for _ in range(3):
-                pixels.fill((255, 255, 255)); pixels.show(); time.sleep(0.05)
-                pixels.fill((0, 0, 0)); pixels.show(); time.sleep(0.05)
+            button_down_times[ch] = None
+            switch_modes[ch] = False
+
+    # 雙擊時間窗過期就清除 (放在事件之後，迴圈延遲時仍以事件時間判斷雙擊)，
+    # 避免久未按壓的舊時間在回捲後被誤判為雙擊
+    for ch in range(NUM_CHANNELS):
+        if last_click_times[ch] is not None and ticks_diff(now, last_click_times[ch]) >= DOUBLE_CLICK_MS:
+            last_click_times[ch] = None
+
+    # 按住中的按鈕: 逐通道檢查是否到達長按 / 解鎖門檻
+    for ch in range(NUM_CHANNELS):
+        if button_down_times[ch] is not None: check_press(ch, now, outgoing)
+
+    # 所有通道的事件合併為一次 USB 寫入
+    if outgoing:
+        if trace_enabled: outgoing.append(f"T:{now}:{ticks_diff(supervisor.ticks_ms(), now)}:LOOP")
+        serial.write(("\n".join(outgoing) + "\n").encode())
                 
     time.sleep(0.001)
\ No newline at end of file